@@ -2,11 +2,22 @@
 This module implements the QEM API adapter plugin for the ODIN server.
 James Hogge, STFC Application Engineering Group.
 """
+import time
+import logging
+
 from odin.adapters.adapter import ApiAdapter, ApiAdapterResponse, request_types, response_types
 from odin.adapters.metadata_tree import MetadataParameterError
-from tornado.escape import json_decode
+from tornado.escape import json_decode, json_encode
 from tornado.ioloop import IOLoop
-from qem.backplane_data import BackplaneData
+from qem.backplane_data import BackplaneData, PreconditionError
+from qem.profile_manager import ProfileError
+from qem.sequence import SequenceError
+from qem.frequency_sweep import SweepError
+from qem.resistor_scan import ScanError
+from qem.regulator import RegulationError
+from qem.hardware_worker import HardwareWorker
+from qem.response_cache import ResponseCache
+from qem.poll_timing import PollTiming
 
 
 class QEMAdapter(ApiAdapter):
@@ -17,6 +28,13 @@ class QEMAdapter(ApiAdapter):
     representation of the parameters of the backplane.
     """
 
+    # Characters in a GET path which indicate a field selection rather than a single path
+    SELECTION_CHARS = ',*?['
+
+    # Response types supported by GET requests
+    RESPONSE_TYPES = ['application/json', 'application/octet-stream',
+                      'application/gzip', 'application/zlib']
+
     def __init__(self, **kwargs):
         """Initialise the QEMAdapter instance.
         This constructor initialises the adapter instance, extracting the appropriate
@@ -32,24 +50,89 @@ class QEMAdapter(ApiAdapter):
         # Retrieve adapter options from incoming argument list
         self.update_interval = float(self.options.get('update_interval', 0.05))
 
+        # On-demand polling options: after idle_timeout seconds without a request, sensors are
+        # polled every idle_interval seconds. Requests are served from a snapshot no older than
+        # max_age seconds. An idle_timeout of zero polls at the full rate at all times.
+        self.idle_timeout = float(self.options.get('idle_timeout', 0.0))
+        self.idle_interval = float(self.options.get('idle_interval', 5.0))
+        self.max_age = float(self.options.get('max_age', 2 * self.update_interval))
+        # Adaptive polling samples each channel at a rate between the update interval and the
+        # floor interval depending on its activity
+        self.adaptive_polling = bool(int(self.options.get('adaptive_polling', 0)))
+        # Managed garbage collection disables automatic collection, running it between poll
+        # cycles instead so that collection pauses do not land within a cycle
+        managed_gc = bool(int(self.options.get('managed_gc', 0)))
+
+        backplane_data_options = {
+            'profile_dir': self.options.get('profile_dir', 'config/profiles'),
+            'state_file': self.options.get('state_file', 'config/device_state.json'),
+            'update_interval': self.update_interval,
+            'adaptive_floor_interval': float(self.options.get('adaptive_floor_interval', 1.0)),
+            'adaptive_threshold': float(self.options.get('adaptive_threshold', 0.002)),
+            'current_deadband': float(self.options.get('current_deadband', 0.0)),
+            'voltage_deadband': float(self.options.get('voltage_deadband', 0.0)),
+            'deadband_relative': bool(int(self.options.get('deadband_relative', 0))),
+            'settle_detect': bool(int(self.options.get('settle_detect', 0))),
+            'settle_tolerance': float(self.options.get('settle_tolerance', 0.002)),
+            'settle_timeout': float(self.options.get('settle_timeout', 1.0)),
+        }
+
+        # Top-level paths for which PUTs are executed asynchronously by the hardware worker
+        async_paths = self.options.get(
+            'async_paths',
+            'clock,resistors,resistor_mode,profiles,sequence,sweep,scan,regulate')
+        self.async_paths = [p.strip() for p in async_paths.split(',') if p.strip()]
+
         # Create a BackplaneData instance
-        self.backplane_data = BackplaneData()
+        self.backplane_data = BackplaneData(**backplane_data_options)
+
+        # Create the hardware worker to execute slow operations off the IOLoop
+        self.worker = HardwareWorker(self.backplane_data.backplane.lock,
+                                     self.backplane_data.complete_job)
+
+        # Initialise the hardware in the background so that the adapter can serve requests
+        # immediately. Asynchronous PUTs are queued behind the initialisation job.
+        self.worker.submit('initialise', self.backplane_data.backplane.initialise)
+
+        self.last_request = time.time()
+        self.idle = False
+        self.update_handle = None
+
+        # Poll loop timing statistics, with collection management started once the long-lived
+        # objects have been created
+        self.timing = PollTiming(managed_gc)
+        self.timing.start_gc_management()
 
         # Start the update loop
         self.update_loop()
 
     @request_types('application/json')
-    @response_types('application/json')
+    @response_types('application/json', 'application/octet-stream',
+                    'application/gzip', 'application/zlib')
     def get(self, path, request):
         """Handle an HTTP GET request.
         This method handles an HTTP GET request routed to the adapter. This passes
         the path of the request to the underlying BackplaneData instance, where it is interpreted
         and returned as a dictionary containing the appropriate parameter tree.
+
+        The path may also be a comma-separated list of glob paths selecting the fields to return,
+        e.g. current_voltage/*/current,power_good, in which case a flat dict of the matching
+        values, keyed by full path, is returned.
+
+        Requesting application/octet-stream at the adapter root returns the sensor readings as
+        a fixed-layout binary record, the layout of which is described by GET schema, and at scan
+        and sweep returns the data of the last resistor scan or frequency sweep as float64
+        values. GET timing
+        returns the poll cycle time, jitter and garbage collection pause statistics.
+        Requesting application/gzip or application/zlib returns the JSON response compressed;
+        parameter tree responses are serialised and compressed once per backplane snapshot.
         :param path: URI path of request
         :param request: HTTP request object
         :return: an ApiAdapterResponse object containing the appropriate response from the backplane
         """
 
+        self.handle_request()
+
         try:
             #Check for metadata argument
             metadata = False
@@ -65,15 +148,40 @@ class QEMAdapter(ApiAdapter):
                                 metadata = bool(arg[1])
             
             #Get response
-            response = self.backplane_data.get(path, metadata)
+            content_type = self.response_type(request)
+            if content_type == 'application/octet-stream':
+                if path.strip('/') == 'scan':
+                    response = self.backplane_data.scan.get_data()
+                elif path.strip('/') == 'sweep':
+                    response = self.backplane_data.sweep.get_data()
+                elif path.strip('/'):
+                    raise ValueError(
+                        'Binary format is only available at the adapter root, scan and sweep')
+                else:
+                    response = self.backplane_data.packer.get_packed()
+            elif path.strip('/') == 'schema':
+                response = self.backplane_data.packer.get_schema()
+            elif path.strip('/') == 'timing':
+                response = self.timing.get_stats()
+            elif path.strip('/').split('/')[0] == 'jobs':
+                response = self.get_jobs(path)
+            elif any(c in path for c in self.SELECTION_CHARS):
+                response = self.backplane_data.select(path)
+            else:
+                response = self.backplane_data.cache.get(path, metadata, content_type)
+
+            # Compress uncached responses if requested
+            if content_type in ResponseCache.ENCODINGS and isinstance(response, dict):
+                response = ResponseCache.ENCODINGS[content_type](json_encode(response))
             status_code = 200
 
         except Exception as e:
             #Return the error
             response = {'error': str(e)}
+            content_type = 'application/json'
             status_code = 400
 
-        return ApiAdapterResponse(response, status_code=status_code)
+        return ApiAdapterResponse(response, content_type=content_type, status_code=status_code)
 
     @request_types('application/json')
     @response_types('application/json')
@@ -83,17 +191,76 @@ class QEMAdapter(ApiAdapter):
         JSON body of the request into a dict, and passes the result with the request path, to
         the underlying PSCUData instance set method, where it is parsed and the appropriate
         actions performed on the PSCU.
+
+        If the body contains an 'expect' field, the PUT is conditional: the expected (partial)
+        state is compared against the current state at the path, returning 412 if it differs,
+        and only values which differ from the current state are written. For a leaf path the
+        new value is given in a 'value' field, e.g. {"value": true, "expect": false}. For
+        asynchronous paths the check is made before the write is queued, so a mismatch returns
+        412 and a write which would change nothing returns 200 without queueing a job.
+
+        Synchronous PUTs return 503 if the hardware worker is busy with the bus, rather than
+        blocking the IOLoop until it is released. All PUTs return 503 if the hardware
+        initialisation has failed, until a PUT to init/retry queues it again.
         :param path: URI path of request
         :param request: HTTP request object
         :return: an ApiAdapterResponse object containing the appropriate response from the PSCU.
         """
 
+        self.handle_request()
+
+        if path.strip('/') == 'init/retry':
+            response, status_code = self.retry_initialise()
+            return ApiAdapterResponse(response, status_code=status_code)
+
         try:
             data = json_decode(request.body)
-            self.backplane_data.set(path, data)
-            response = self.backplane_data.get(path, False)
-            status_code = 200
-        except MetadataParameterError as e:
+            expect = None
+            if isinstance(data, dict) and 'expect' in data:
+                expect = data.pop('expect')
+                if self.backplane_data.is_parameter(path):
+                    if 'value' not in data:
+                        raise ValueError('conditional PUT to a parameter requires a value field')
+                    data = data['value']
+
+            # Check a conditional PUT against the shadow state before queueing it, so that a
+            # mismatch or a write which would change nothing is answered immediately. The job
+            # checks again in case the state changes while it is queued.
+            unchanged = False
+            if (expect is not None and self.is_async(path, data) and
+                    self.backplane_data.backplane.ready):
+                data = self.backplane_data.check_precondition(path, data, expect)
+                unchanged = data is None
+
+            if self.backplane_data.backplane.init_error:
+                response = {'error': 'Backplane hardware initialisation failed: {}'.format(
+                    self.backplane_data.backplane.init_error)}
+                status_code = 503
+            elif unchanged:
+                response = self.backplane_data.get(path, False)
+                status_code = 200
+            elif self.is_async(path, data):
+                job = self.worker.submit(path, self.set_and_get, path, data, expect)
+                response = {'job': job.id, 'status': job.status}
+                status_code = 202
+            elif not self.backplane_data.backplane.ready:
+                response = {'error': 'Backplane hardware is not ready'}
+                status_code = 503
+            elif not self.backplane_data.backplane.lock.acquire(False):
+                # Never wait on the IOLoop for a hardware worker job to release the bus
+                response = {'error': 'Backplane hardware is busy, retry the request'}
+                status_code = 503
+            else:
+                try:
+                    response = self.set_and_get(path, data, expect)
+                finally:
+                    self.backplane_data.backplane.lock.release()
+                status_code = 200
+        except PreconditionError as e:
+            response = {'error': str(e), 'current': self.backplane_data.get(path, False)}
+            status_code = 412
+        except (MetadataParameterError, ProfileError, SequenceError, SweepError, ScanError,
+                RegulationError) as e:
             response = {'error': str(e)}
             status_code = 400
         except (TypeError, ValueError) as e:
@@ -101,15 +268,165 @@ class QEMAdapter(ApiAdapter):
             status_code = 400
         return ApiAdapterResponse(response, status_code=status_code)
 
+    def response_type(self, request):
+        """Determine the response type requested by the Accept header of a request.
+
+        This resolves the type in the same way as the response_types decorator, i.e. the first
+        type in the Accept header supported by the adapter.
+
+        :param request: HTTP request object
+        :return: requested response type, application/json if none is supported
+        """
+        for accept_type in request.headers.get('Accept', '').split(','):
+            accept_type = accept_type.split(';')[0].strip()
+            if accept_type in self.RESPONSE_TYPES:
+                return accept_type
+        return 'application/json'
+
+    def is_async(self, path, data):
+        """Determine if a PUT should be executed asynchronously by the hardware worker.
+
+        :param path: URI path of request
+        :param data: decoded request body
+        :return: True if the PUT accesses any of the configured asynchronous paths
+        """
+        levels = [level for level in path.split('/') if level]
+        if levels:
+            return levels[0] in self.async_paths
+        return isinstance(data, dict) and any(key in self.async_paths for key in data)
+
+    def set_and_get(self, path, data, expect=None):
+        """Set the parameters at a path and return their updated state.
+
+        The caller must hold the backplane lock.
+
+        :param path: path of the parameters to set
+        :param data: values to set
+        :param expect: expected current state for a conditional PUT, None if unconditional
+        :return: dict of the parameter tree at the path
+        """
+        # Jobs queued behind a failed initialisation are answered with its error
+        backplane = self.backplane_data.backplane
+        if not backplane.ready:
+            raise RuntimeError('Backplane hardware is not ready: {}'.format(
+                backplane.init_error or 'initialisation has not completed'))
+
+        if expect is not None:
+            self.backplane_data.compare_and_set(path, data, expect)
+        else:
+            self.backplane_data.set(path, data)
+        return self.backplane_data.get(path, False)
+
+    def retry_initialise(self):
+        """Queue the hardware initialisation again after it has failed.
+
+        :return: tuple of the response and status code, 202 with the initialisation job, or
+                 400 if the initialisation has not failed
+        """
+        backplane = self.backplane_data.backplane
+        if not backplane.init_error:
+            return {'error': 'Backplane hardware initialisation has not failed'}, 400
+
+        backplane.clear_init_error()
+        job = self.worker.submit('initialise', backplane.initialise)
+        return {'job': job.id, 'status': job.status}, 202
+
+    def get_jobs(self, path):
+        """Get the status of hardware worker jobs.
+
+        :param path: URI path of request, either jobs or jobs/<id>
+        :return: dict of the status of all retained jobs, or of a single job
+        """
+        levels = [level for level in path.split('/') if level]
+        if len(levels) == 1:
+            return {'jobs': self.worker.get_jobs(), 'pending': self.worker.pending()}
+
+        job = self.worker.get_job(int(levels[1]))
+        if job is None or len(levels) > 2:
+            raise KeyError('Invalid path: {}'.format(path))
+        return job.to_dict()
+
+    def handle_request(self):
+        """Record the arrival of a request for on-demand polling.
+
+        If polling has dropped to the idle rate, the update loop is restarted at the full rate
+        and, if the current snapshot is older than max_age, the sensors are polled before the
+        request is served.
+        """
+        self.last_request = time.time()
+
+        if self.last_request - self.backplane_data.backplane.update_time > self.max_age:
+            self.poll_sensors()
+
+        if self.idle:
+            logging.debug("Request received, resuming full rate polling")
+            self.idle = False
+            if self.update_handle is not None:
+                IOLoop.instance().remove_timeout(self.update_handle)
+            self.update_handle = IOLoop.instance().call_later(self.update_interval,
+                                                              self.update_loop)
+            self.timing.schedule(self.update_interval)
+            self.backplane_data.scheduler.set_polling(self.adaptive_polling, self.update_interval)
+
+    def poll_sensors(self):
+        """Poll the backplane sensors.
+
+        The poll is skipped if the hardware is not yet initialised or the hardware worker holds
+        the bus.
+        """
+        if not self.backplane_data.backplane.ready:
+            return
+
+        lock = self.backplane_data.backplane.lock
+        if lock.acquire(False):
+            try:
+                if self.adaptive_polling:
+                    self.backplane_data.scheduler.poll()
+                else:
+                    self.backplane_data.backplane.poll_all_sensors()
+            finally:
+                lock.release()
+
     def update_loop(self):
         """Handle background update loop tasks.
         This method polls the sensors in the background and is executed periodically in the tornado
-        IOLoop instance.
+        IOLoop instance. If on-demand polling is enabled, the loop runs at the idle interval when
+        no request has been received within the idle timeout.
         """
         # Handle background tasks
-        self.backplane_data.backplane.poll_all_sensors()
+        self.timing.start_cycle()
+        self.poll_sensors()
+        self.timing.end_cycle()
+
+        idle = self.idle_timeout > 0 and time.time() - self.last_request > self.idle_timeout
+        if idle and not self.idle:
+            logging.debug("No requests for %.1fs, polling every %.1fs",
+                          self.idle_timeout, self.idle_interval)
+        self.idle = idle
 
         # Schedule the update loop to run in the IOLoop instance again after appropriate
         # interval
-        IOLoop.instance().call_later(self.update_interval, self.update_loop)
+        interval = self.idle_interval if self.idle else self.update_interval
+        self.update_handle = IOLoop.instance().call_later(interval, self.update_loop)
+        self.timing.schedule(interval)
+        self.backplane_data.scheduler.set_polling(self.adaptive_polling, interval)
 
+        # Run any garbage collection due in the gap before the next cycle. While the hardware
+        # worker holds the bus the collection is left to a later cycle, so that its pause does
+        # not land within the worker's bus transactions.
+        lock = self.backplane_data.backplane.lock
+        if lock.acquire(False):
+            try:
+                self.timing.collect()
+            finally:
+                lock.release()
+
+    def cleanup(self):
+        """Clean up the state of the adapter at shutdown.
+
+        This method is called by the ODIN server at shutdown to allow any queued hardware
+        operations to complete and save the device state for the next startup.
+        """
+        self.worker.stop()
+        if self.backplane_data.backplane.ready:
+            self.backplane_data.backplane.save_state()
@@ -1,3 +1,10 @@
+import time
+import logging
+import threading
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
 from lpdpower.i2c_device import I2CDevice, I2CException
 from lpdpower.i2c_container import I2CContainer
 
@@ -6,93 +13,345 @@ from mcp23008 import MCP23008
 from tpl0102 import TPL0102
 from si570 import SI570
 from ad7998 import AD7998
+from channel_store import ChannelStore
+from device_state import DeviceStateStore
+from settling import SettlingDetector
 
 class Backplane(I2CContainer):
     
     CURRENT_MULTIPLIERS = [19.5, 19.5, 1.95, 7.8, 19.5, 19.5, 1.95, 1.2, 1.2, 1.2, 1.2, 0.122, 0.122]
+    VOLTAGE_MULTIPLIERS = [0.000732] * 7 + [1.2] * 6
+    ADC_CHANNELS = tuple(range(ChannelStore.NUM_ADC_CHANNELS))
+    POWER_GOOD_PINS = tuple(range(ChannelStore.NUM_POWER_GOOD))
+    #(TPL0102 index, wiper) controlling each variable resistor
+    RESISTOR_WIPERS = [(0, 0), (0, 1), (1, 0), (2, 0), (2, 1), (3, 0), (4, 0)]
+    #Number of TPL0102 wiper codes
+    NUM_WIPER_CODES = 256
+    #ADC channels monitoring the rails set by the resistors, all channels if not listed
+    RESISTOR_CHANNELS = {3: [8], 4: [9], 5: [11, 12]}
 
-    def __init__(self):
+    def __init__(self, state_file=None):
 
-        #Set up I2C devices
-        self.tca = TCA9548(0x70, busnum=1)
+        #Serialises bus access between the poll loop and the hardware worker
+        self.lock = threading.RLock()
+
+        #Shadow register state saved by the previous run, allowing devices to verify their
+        #state rather than read it back in full
+        self.device_state = DeviceStateStore(state_file)
+
+        #Optional wait for the affected rails to settle after setpoint changes
+        self.settling = SettlingDetector(self)
 
+        #I2C devices, created by initialise() so that the backplane can be served before the
+        #slow hardware setup has completed
+        self.tca = None
         self.tpl0102 = []
+        self.si570 = None
+        self.ad7998 = []
+        self.mcp23008 = []
+        self.adc_inputs = ()
+        self.ready = False
+        self.init_error = None
+        self.init_times = OrderedDict()
+
+        #Channel state, held in a compact array-backed store. Raw readings are published to
+        #currents/voltages only when they move beyond the channel's deadband, which may be
+        #absolute or relative to the published value
+        self.store = ChannelStore()
+        self.voltages = self.store.voltages
+        self.currents = self.store.currents
+        self.raw_voltages = self.store.raw_voltages
+        self.raw_currents = self.store.raw_currents
+        self.current_deadbands = self.store.current_deadbands
+        self.voltage_deadbands = self.store.voltage_deadbands
+        self.deadband_relative = self.store.deadband_relative
+        #Update count of the snapshot in which each channel was last published
+        self.changed_counts = self.store.changed_counts
+        self.power_good = self.store.power_good
+        #Last GPIO register read from the power good monitor, all pins low initially
+        self.power_good_mask = 0
+        self.update_count = 0
+        self.update_time = 0.0
+        self.poll_changed = False
+        self.psu_enabled = False
+        self.clock_freq = 21.0
+        #Resistor wipers are written to volatile registers only when in volatile mode, with
+        #positions copied to non-volatile memory by an explicit commit
+        self.volatile_mode = False
+        self.last_commit = 0.0
+        #Path taken by the last clock change, full reprogram or small RFREQ step
+        self.clock_path = None
+        #Variable resistors, with a table of the value of each wiper code. Values increase with
+        #the code, so that the nearest code to a value is found by bisection.
+        self.resistors = self.store.resistors
+        self.resistor_luts = [
+            array('d', [self.wiper_value(resistor, code) for code in range(self.NUM_WIPER_CODES)])
+            for resistor in range(len(self.resistors))]
+
+    def initialise(self):
+        #Set up the I2C devices, logging the time taken by each so that the cost of startup
+        #can be seen. The backplane is ready once all devices have been set up.
+        with self.lock:
+            start = time.time()
+            self.init_times.clear()
+            try:
+                self.init_device("tca9548", self.init_tca)
+                self.init_device("tpl0102", self.init_tpl0102)
+                self.init_device("si570", self.init_si570)
+                self.save_state()
+                self.init_device("ad7998", self.init_ad7998)
+                self.init_device("mcp23008", self.init_mcp23008)
+                self.init_device("resistors", self.init_resistors)
+                self.save_state()
+            except Exception as e:
+                #The device which failed is the last to have been started
+                self.init_error = "{}: {}".format(next(reversed(self.init_times)), e)
+                logging.error("Backplane initialisation failed: %s", self.init_error)
+                self.update_count += 1
+                raise
+
+            self.ready = True
+            #Start a new snapshot so that cached responses include the initialised state
+            self.update_count += 1
+            logging.info("Backplane initialised in %.3fs", time.time() - start)
+
+    def init_device(self, name, func):
+        self.init_times[name] = None
+        start = time.time()
+        func()
+        self.init_times[name] = time.time() - start
+        logging.info("Initialised %s in %.3fs", name, self.init_times[name])
+
+    def clear_init_error(self):
+        #Clear the error of a failed initialisation before it is retried, starting a new
+        #snapshot so that cached responses no longer report it
+        self.init_error = None
+        self.update_count += 1
+
+    def get_ready(self):
+        return self.ready
+
+    def get_init_error(self):
+        return self.init_error or ""
+
+    def get_init_times(self):
+        return dict(self.init_times)
+
+    def init_tca(self):
+        self.tca = TCA9548(0x70, busnum=1)
+
+    def device_name(self, device_type, address):
+        return "{}_{:#04x}".format(device_type.__name__.lower(), address)
+
+    def attach_device(self, channel, device_type, address):
+        #Attach a device, passing any saved state for it to verify
+        state = self.device_state.get(self.device_name(device_type, address))
+        return self.tca.attach_device(channel, device_type, address, busnum=1, state=state)
+
+    def save_state(self):
+        #Persist the shadow register state of the devices, written only when it has changed
+        devices = {}
+        for device in self.tpl0102 + self.mcp23008 + [self.si570]:
+            devices[self.device_name(type(device), device.address)] = device.get_state()
+        self.device_state.save(devices)
+
+    def init_tpl0102(self):
+        tpl0102 = []
         for i in range(5):
-            self.tpl0102.append(self.tca.attach_device(0, TPL0102, 0x50 + i, busnum=1))
+            tpl0102.append(self.attach_device(0, TPL0102, 0x50 + i))
         for i in range(5):
-            self.tpl0102[i].set_non_volatile(True)
-        self.tpl0102[0].set_terminal_PDs(0, 0, 2.5)
-        self.tpl0102[0].set_terminal_PDs(1, 0, 2.5)
-        self.tpl0102[1].set_terminal_PDs(0, 0, 100)
-        self.tpl0102[3].set_terminal_PDs(0, -2, 3.3)
-        self.tpl0102[4].set_terminal_PDs(0, 0, 2.5)
+            tpl0102[i].set_non_volatile(True)
+        self.tpl0102 = tpl0102
 
-        self.si570 = self.tca.attach_device(1, SI570, 0x55, busnum=1)
-        self.si570.set_frequency(21) #Default to 21MHz
+    def init_si570(self):
+        #The SI570 keeps running at its current frequency if its crystal frequency was saved,
+        #and is only reprogrammed if that differs from the default
+        self.si570 = self.attach_device(1, SI570, 0x55)
+        if abs(self.si570.get_frequency() - self.clock_freq) > 1e-6:
+            self.clock_path = self.si570.set_frequency(self.clock_freq) #Default to 21MHz
 
-        self.ad7998 = []
+    def init_ad7998(self):
+        ad7998 = []
         for i in range(4):
-            self.ad7998.append(self.tca.attach_device(2, AD7998, 0x24 + i, busnum=1))
+            ad7998.append(self.tca.attach_device(2, AD7998, 0x24 + i, busnum=1))
 
-        self.mcp23008 = []
-        self.mcp23008.append(self.tca.attach_device(3, MCP23008, 0x20, busnum=1))
-        self.mcp23008.append(self.tca.attach_device(3, MCP23008, 0x42, busnum=1))
-        for i in range(8):
-            self.mcp23008[0].setup(i, MCP23008.IN)
-        self.mcp23008[1].setup(0, MCP23008.OUT)
-
-        #Sensor readings
-        self.voltages = [0.0] * 13
-        self.currents = [0.0] * 13
-        self.power_good = [False] * 8
-        self.psu_enabled = self.mcp23008[1].input(0)
-        self.clock_freq = 21.0
-        #Variable resistors
-        self.resistors = [
-            self.tpl0102[0].get_wiper(0) * 0.0097,
-            self.tpl0102[0].get_wiper(1) * 0.0097,
-            self.tpl0102[1].get_wiper(0) * 0.29,
-            0.0001 / (1.0/49900 + 1.0/self.tpl0102[2].get_wiper(0)/390.0),
-            0.0001 / (1.0/18200 + 1.0/self.tpl0102[2].get_wiper(1)/390.0),
-            self.tpl0102[3].get_wiper(0) * 0.021 - 2,
-            self.tpl0102[4].get_wiper(0) * 0.0097,
-        ]
-
-    def poll_all_sensors(self):
-        #Currents
-        for i in range(7):
-            self.currents[i] = self.ad7998[0].read_input_scaled(i) * self.CURRENT_MULTIPLIERS[i]
-        for i in range(6):
-            self.currents[i + 7] = self.ad7998[2].read_input_scaled(i) * self.CURRENT_MULTIPLIERS[i + 7]
+        #Precomputed (current ADC, voltage ADC, input) for each channel, so the poll loop
+        #need not build ranges or recompute indices on each cycle
+        self.adc_inputs = tuple(
+            (ad7998[0], ad7998[1], i) if i < 7 else (ad7998[2], ad7998[3], i - 7)
+            for i in self.ADC_CHANNELS)
+        self.ad7998 = ad7998
 
-        #Voltages
-        for i in range(7):
-            self.voltages[i] = self.ad7998[1].read_input_scaled(i) * 0.000732
-        for i in range(6):
-            self.voltages[i + 7] = self.ad7998[3].read_input_scaled(i) * 1.2
+    def init_mcp23008(self):
+        mcp23008 = []
+        mcp23008.append(self.attach_device(3, MCP23008, 0x20))
+        mcp23008.append(self.attach_device(3, MCP23008, 0x42))
+        for i in range(8):
+            mcp23008[0].setup(i, MCP23008.IN)
+        mcp23008[1].setup(0, MCP23008.OUT)
+        self.psu_enabled = mcp23008[1].input(0)
+        self.mcp23008 = mcp23008
 
-        #Power good monitors
-        self.power_good = self.mcp23008[0].input_pins([0,1,2,3,4,5,6,7,8])
+    def init_resistors(self):
+        for resistor in range(len(self.resistors)):
+            code = self.get_resistor_wiper(resistor)
+            self.resistors[resistor] = self.resistor_luts[resistor][code]
 
-    def set_resistor_value(self, resistor, value):
-        if resistor == 0:
-            self.tpl0102[0].set_PD(0, value)
-        elif resistor == 1:
-            self.tpl0102[0].set_PD(1, value)
+    def wiper_value(self, resistor, code):
+        #Value of a resistor for a wiper code, used to build the lookup tables
+        if resistor in (0, 1, 6):
+            return code * 0.0097
         elif resistor == 2:
-            self.tpl0102[1].set_PD(0, value)
+            return code * 0.29
         elif resistor == 3:
-            wiper = int(1.0 / (0.039/value - 390.0/49900))
-            self.tpl0102[2].set_wiper(0, wiper)
+            return 0.0001 / (1.0/49900 + 1.0/code/390.0) if code else 0.0
         elif resistor == 4:
-            wiper = int(1.0 / (0.039 / (value - 17800) - 390.0/18200))
-            self.tpl0102[2].set_wiper(1, wiper)
+            return 0.0001 / (1.0/18200 + 1.0/code/390.0) if code else 0.0
         elif resistor == 5:
-            self.tpl0102[3].set_PD(0, value)
-        elif resistor == 6:
-            self.tpl0102[4].set_PD(0, value)
+            return code * 0.021 - 2
+
+    def get_resistor_wiper(self, resistor):
+        device, wiper = self.RESISTOR_WIPERS[resistor]
+        return self.tpl0102[device].get_wiper(wiper)
+
+    def set_resistor_wiper(self, resistor, code, save=True):
+        #Set a resistor by wiper code, e.g. when scanning. Saving the device state may be
+        #deferred when many codes are set in turn.
+        device, wiper = self.RESISTOR_WIPERS[resistor]
+        self.tpl0102[device].set_wiper(wiper, code)
+        self.resistors[resistor] = self.resistor_luts[resistor][code]
+        if save:
+            self.save_state()
 
-        self.resistors[resistor] = value
+    def poll_all_sensors(self):
+        self.poll_channels(self.ADC_CHANNELS)
+
+    def poll_channels(self, channels):
+        #Poll a subset of the current/voltage channels, e.g. as chosen by a poll scheduler,
+        #and the power good monitors
+        for i in channels:
+            self.poll_channel(i)
+
+        self.poll_power_good()
+
+        self.complete_poll()
+
+    def poll_channel(self, i):
+        #Readings are written into the preallocated store arrays, so that a steady-state poll
+        #cycle makes no lasting allocations
+        current_adc, voltage_adc, adc_input = self.adc_inputs[i]
+        raw_current = current_adc.read_input_scaled(adc_input) * self.CURRENT_MULTIPLIERS[i]
+        raw_voltage = voltage_adc.read_input_scaled(adc_input) * self.VOLTAGE_MULTIPLIERS[i]
+        self.raw_currents[i] = raw_current
+        self.raw_voltages[i] = raw_voltage
+
+        #Publish the channel if either reading has moved beyond its deadband
+        relative = self.deadband_relative[i]
+        if (self.exceeds_deadband(raw_current, self.currents[i],
+                                  self.current_deadbands[i], relative) or
+                self.exceeds_deadband(raw_voltage, self.voltages[i],
+                                      self.voltage_deadbands[i], relative)):
+            self.currents[i] = raw_current
+            self.voltages[i] = raw_voltage
+            self.changed_counts[i] = self.update_count + 1
+            self.poll_changed = True
+
+    def exceeds_deadband(self, value, published, deadband, relative):
+        if relative:
+            deadband *= abs(published)
+        return abs(value - published) > deadband
+
+    def poll_power_good(self):
+        #Compare the raw GPIO register, only unpacking the pin states when it has changed
+        mask = self.mcp23008[0].input_mask()
+        if mask != self.power_good_mask:
+            self.power_good_mask = mask
+            for pin in self.POWER_GOOD_PINS:
+                self.power_good[pin] = bool(mask & (1 << pin))
+            self.poll_changed = True
+
+    def complete_poll(self):
+        #The update count identifies each snapshot of the published readings, changing only
+        #when a reading has been published. The update time records when the readings were
+        #last known to be current.
+        if self.poll_changed:
+            self.update_count += 1
+            self.poll_changed = False
+        self.update_time = time.time()
+
+    def get_current_deadband(self, i):
+        return self.current_deadbands[i]
+
+    def set_current_deadband(self, i, value):
+        self.current_deadbands[i] = float(value)
+
+    def get_voltage_deadband(self, i):
+        return self.voltage_deadbands[i]
+
+    def set_voltage_deadband(self, i, value):
+        self.voltage_deadbands[i] = float(value)
+
+    def get_deadband_relative(self, i):
+        return self.deadband_relative[i]
+
+    def set_deadband_relative(self, i, value):
+        self.deadband_relative[i] = bool(value)
+
+    def get_changed(self, i):
+        return self.changed_counts[i] == self.update_count
+
+    def nearest_wiper_code(self, resistor, value):
+        #Wiper code whose value is nearest to the requested value
+        lut = self.resistor_luts[resistor]
+        if not lut[0] <= value <= lut[-1]:
+            raise ValueError("{} value {} is outside the range {:g} to {:g} {}".format(
+                self.get_resistor_name(resistor), value, lut[0], lut[-1],
+                self.get_resistor_units(resistor)))
+
+        code = bisect_left(lut, value)
+        if code > 0 and value - lut[code - 1] <= lut[code] - value:
+            code -= 1
+        return code
+
+    def set_resistor_value(self, resistor, value):
+        #The value read back is that of the code set, which may differ from the requested value
+        #by up to half a step
+        self.set_resistor_wiper(resistor, self.nearest_wiper_code(resistor, value))
+
+        if self.settling.enabled:
+            self.settling.wait(self.get_resistor_name(resistor),
+                               self.get_resistor_channels(resistor))
+
+    def get_volatile_mode(self):
+        return self.volatile_mode
+
+    def set_volatile_mode(self, enable):
+        #Switch the resistor wipers between fast volatile writes and non-volatile writes
+        for tpl0102 in self.tpl0102:
+            tpl0102.set_non_volatile(not enable)
+        self.volatile_mode = bool(enable)
+        self.save_state()
+
+    def commit_resistor(self, resistor):
+        #Copy the wipers of the device controlling a resistor to non-volatile memory
+        device, _ = self.RESISTOR_WIPERS[resistor]
+        self.tpl0102[device].commit()
+        self.last_commit = time.time()
+        self.save_state()
+
+    def commit_resistors(self, value=None):
+        #Copy all wipers to non-volatile memory. The value is ignored, allowing a commit to
+        #be triggered by a PUT of any value.
+        for tpl0102 in self.tpl0102:
+            tpl0102.commit()
+        self.last_commit = time.time()
+        self.save_state()
+
+    def get_last_commit(self):
+        return self.last_commit
+
+    def get_resistor_channels(self, resistor):
+        return self.RESISTOR_CHANNELS.get(resistor, list(self.ADC_CHANNELS))
 
     def get_resistor_value(self, resistor):
         return self.resistors[resistor]
@@ -111,7 +370,13 @@ class Backplane(I2CContainer):
 
     def set_clock_frequency(self, freq):
         self.clock_freq = freq
-        self.si570.set_frequency(freq)
+        self.clock_path = self.si570.set_frequency(freq)
+
+        if self.settling.enabled:
+            self.settling.wait("clock", list(self.ADC_CHANNELS))
+
+    def get_clock_path(self):
+        return self.clock_path or ""
 
     def get_psu_enable(self):
         return self.psu_enabled
@@ -126,6 +391,24 @@ class Backplane(I2CContainer):
     def get_voltage(self, i):
         return self.voltages[i]
 
+    def get_adc_channel(self, channel):
+        #Resolve a current/voltage channel given by name or index to its index
+        names = [self.get_adc_name(i) for i in self.ADC_CHANNELS]
+        if channel in names:
+            return names.index(channel)
+        if isinstance(channel, int) and channel in self.ADC_CHANNELS:
+            return channel
+        raise ValueError("Unknown channel {}".format(channel))
+
+    def get_resistor_index(self, resistor):
+        #Resolve a resistor given by name or index to its index
+        names = [self.get_resistor_name(i) for i in range(len(self.resistors))]
+        if resistor in names:
+            return names.index(resistor)
+        if isinstance(resistor, int) and 0 <= resistor < len(self.resistors):
+            return resistor
+        raise ValueError("Unknown resistor {}".format(resistor))
+
     def get_adc_name(self, i):
         return ["VDD0_D18", "VDD_D25", "VDD_D18_PLL", "VDDO", "VDD_D18ADC",
              "VDD_P18", "VDD_A18_PLL", "VDD_D33", "VDD_RST", "VRESET",
@@ -1,79 +1,243 @@
 from backplane import Backplane
+from profile_manager import ProfileManager
+from sequence import SequenceRunner
+from frequency_sweep import FrequencySweep
+from resistor_scan import ResistorScan
+from regulator import ResistorRegulator
+from path_index import PathIndex
+from sensor_packer import SensorPacker
+from response_cache import ResponseCache
+from poll_scheduler import AdaptivePollScheduler
+from channel_store import CHANNEL_SCHEMA
 from odin.adapters.metadata_tree import MetadataTree
-
-class PowerGood(object):
-    def __init__(self, backplane, i):
-        self.index = i
-        self.backplane = backplane
-
-    def get(self):
-        return self.backplane.get_power_good(self.index)
-
-class CurrentVoltage(object):
-    def __init__(self, backplane, i):
-        self.index = i
-        self.backplane = backplane
-
-        self.param_tree = MetadataTree({
-            "name" : self.backplane.get_adc_name(i),
-            "current" : (self.get_current, {"units" : "mA"}),
-            "voltage" : (self.get_voltage, {"units" : "V"})
-        })
-
-    def get_current(self):
-        return self.backplane.get_current(self.index)
-
-    def get_voltage(self):
-        return self.backplane.get_voltage(self.index)
-
-class Resistor(object):
-    def __init__(self, backplane, i):
-        self.index = i
-        self.backplane = backplane
-        
-        self.param_tree = MetadataTree({
-            "name" : self.backplane.get_resistor_name(i),
-            "value" : (self.get, self.set, {"units" : self.backplane.get_resistor_units(self.index)})
-        })
-
-    def get(self):
-        return self.backplane.get_resistor_value(self.index)
-
-    def set(self, value):
-        self.backplane.set_resistor_value(self.index, value)
+from functools import partial
+from operator import getitem
+
+class PreconditionError(Exception):
+    pass
+
+def _as_dict(node):
+    # Lists in the parameter tree are addressed by string index
+    if isinstance(node, list):
+        return {str(i) : v for i, v in enumerate(node)}
+    return node
+
+def _child_path(path, key):
+    return path + '/' + key if path else key
+
+def _matches(expected, current, path, leaves):
+    # Partial match of an expected subtree against the current state. Parameters are
+    # compared as whole values, even where their values are dicts or lists.
+    if path in leaves or not isinstance(expected, (dict, list)):
+        return expected == current
+    expected, current = _as_dict(expected), _as_dict(current)
+    if not isinstance(current, dict):
+        return False
+    return all(k in current and _matches(v, current[k], _child_path(path, k), leaves)
+               for k, v in expected.items())
+
+def _prune(data, current, path, leaves):
+    # Remove the values in data which already match the current state, None if all match.
+    # Parameter values are never pruned in part, so that e.g. a command payload is written
+    # whole. Data which is not valid for a branch is left for the write to reject.
+    if path in leaves:
+        return None if data == current else data
+    if isinstance(data, (dict, list)) and isinstance(current, (dict, list)):
+        data, current = _as_dict(data), _as_dict(current)
+        pruned = {}
+        for k, v in data.items():
+            if k in current:
+                v = _prune(v, current[k], _child_path(path, k), leaves)
+            if v is not None:
+                pruned[k] = v
+        return pruned or None
+    return data
 
 class BackplaneData(object):
 
-    def __init__(self):
-        self.backplane = Backplane()
-        
-        self.power_good = []
-        for i in range(8):
-            self.power_good.append(PowerGood(self.backplane, i))
-
-        self.current_voltage = []
+    def __init__(self, profile_dir='config/profiles', state_file='config/device_state.json',
+                 update_interval=0.05, adaptive_floor_interval=1.0, adaptive_threshold=0.002,
+                 current_deadband=0.0, voltage_deadband=0.0, deadband_relative=False,
+                 settle_detect=False, settle_tolerance=0.002, settle_timeout=1.0):
+        self.backplane = Backplane(state_file)
         for i in range(13):
-            self.current_voltage.append(CurrentVoltage(self.backplane, i))
-
-        self.resistors = []
-        for i in range(7):
-            self.resistors.append(Resistor(self.backplane, i))
-
-        pw_good = {str(i) : pg.get for i,pg in enumerate(self.power_good)}
+            self.backplane.set_current_deadband(i, current_deadband)
+            self.backplane.set_voltage_deadband(i, voltage_deadband)
+            self.backplane.set_deadband_relative(i, deadband_relative)
+        settling = self.backplane.settling
+        settling.set_enabled(settle_detect)
+        settling.set_tolerance(settle_tolerance)
+        settling.set_timeout(settle_timeout)
+        self.scheduler = AdaptivePollScheduler(self.backplane, update_interval,
+                                               adaptive_floor_interval, adaptive_threshold)
+        self.profiles = ProfileManager(self.backplane, profile_dir)
+        self.sequence = SequenceRunner(self, update_interval)
+        self.sweep = FrequencySweep(self.backplane)
+        self.scan = ResistorScan(self.backplane)
+        self.regulator = ResistorRegulator(self.backplane)
+        self.packer = SensorPacker(self.backplane)
+        self.cache = ResponseCache(self)
+        self.write_count = 0
+        self.job_count = 0
+
+        self.store = self.backplane.store
+
+        pw_good = {str(i) : partial(getitem, self.store.power_good, i)
+                   for i in range(len(self.store.power_good))}
         pw_good.update({"list" : True, "description" : "Power good inputs from the MCP23008"})
 
-        self.param_tree = MetadataTree({
+        tree = {
             "name" : "QEM Backplane",
             "description" : "Testing information for the backplane on QEM.",
             "clock" : (self.backplane.get_clock_frequency, self.backplane.set_clock_frequency, {"units" : "MHz", "description" : "Clock frequency for the SI570 oscillator"}),
+            "settling" : {
+                "enabled" : (settling.get_enabled, settling.set_enabled,
+                             {"description" : "Wait for the affected rails to settle after "
+                                              "resistor and clock changes"}),
+                "tolerance" : (settling.get_tolerance, settling.set_tolerance,
+                               {"description" : "Settling band as a fraction of full scale"}),
+                "timeout" : (settling.get_timeout, settling.set_timeout, {"units" : "s"}),
+                "last" : (settling.get_last, {"description" : "Result of the last settling wait"}),
+                "description" : "Settling detection after setpoint changes"
+            },
+            "resistor_mode" : {
+                "volatile" : (self.backplane.get_volatile_mode, self.backplane.set_volatile_mode,
+                              {"description" : "Write resistor wipers to "
+                                               "volatile registers only"}),
+                "commit" : (self.backplane.get_last_commit, self.backplane.commit_resistors,
+                            {"units" : "s",
+                             "description" : "Copy resistor wipers to non-volatile memory, "
+                                             "reads the time of the last commit"}),
+                "description" : "Volatile resistor writes with explicit non-volatile commit"
+            },
+            "clock_path" : (self.backplane.get_clock_path,
+                            {"description" : "Update path of the last clock change, full or "
+                                             "small_step (RFREQ only)"}),
+            "ready" : (self.backplane.get_ready,
+                       {"description" : "Hardware initialisation has completed"}),
+            "init" : {
+                "error" : self.backplane.get_init_error,
+                "times" : (self.backplane.get_init_times,
+                           {"units" : "s", "description" : "Initialisation time of each device"}),
+                "description" : "Background hardware initialisation"
+            },
             "psu_enabled" : (self.backplane.get_psu_enable, self.backplane.set_psu_enable, {"name" : "PSU Enabled"}),
             "power_good" : pw_good,
-            "current_voltage" : [cv.param_tree for cv in self.current_voltage],
-            "resistors" : [r.param_tree for r in self.resistors]
-        })
+            "current_voltage" : self.build_channels("current_voltage"),
+            "resistors" : self.build_channels("resistors"),
+            "profiles" : {
+                "available" : self.profiles.get_available,
+                "apply" : (self.profiles.get_active, self.profiles.apply_profile,
+                           {"description" : "Name of the board configuration profile to apply"}),
+                "last_apply" : self.profiles.get_last_apply,
+                "description" : "Named board configuration profiles"
+            },
+            "sequence" : {
+                "run" : (self.sequence.get_results, self.sequence.run,
+                         {"description" : "List of set/get/wait/wait_until steps to run"}),
+                "time" : (self.sequence.get_time, {"units" : "s"}),
+                "description" : "Server-side command sequences"
+            },
+            "sweep" : {
+                "run" : (self.sweep.get_results, self.sweep.run,
+                         {"description" : "Clock frequency sweep of start/stop/step or "
+                                          "frequencies, settle and channels"}),
+                "time" : (self.sweep.get_time, {"units" : "s"}),
+                "description" : "SI570 clock frequency sweeps with sensor capture"
+            },
+            "scan" : {
+                "run" : (self.scan.get_results, self.scan.run,
+                         {"description" : "Resistor scan of 1 or 2 axes of wiper codes, settle, "
+                                          "samples and channels"}),
+                "time" : (self.scan.get_time, {"units" : "s"}),
+                "description" : "Variable resistor scans with sensor capture"
+            },
+            "regulate" : (self.regulator.get_results, self.regulator.regulate,
+                          {"description" : "Closed-loop regulation of a resistor to a target "
+                                           "reading of a feedback channel"}),
+        }
+
+        self.param_tree = MetadataTree(tree)
+
+        #Flat index of the tree used for requests without metadata
+        self.index = PathIndex(tree, self.param_tree.get("", metadata=False))
+
+    def resolve(self, name):
+        #Resolve a dotted accessor name from the channel schema
+        obj = self
+        for attr in name.split('.'):
+            obj = getattr(obj, attr)
+        return obj
+
+    def build_channels(self, group):
+        #Generate the parameter tree of a channel group from the channel schema, binding
+        #accessors directly to the channel store arrays where possible
+        count, name_accessor, fields = CHANNEL_SCHEMA[group]
+        name_accessor = self.resolve(name_accessor)
+
+        channels = []
+        for i in range(count):
+            channel = {"name" : name_accessor(i)}
+            for key, source, setter, metadata in fields:
+                source = self.resolve(source)
+                getter = partial(source, i) if callable(source) else partial(getitem, source, i)
+                metadata = {k : self.resolve(v[1:])(i)
+                                if isinstance(v, str) and v.startswith('@') else v
+                            for k, v in metadata.items()}
+                if setter is not None:
+                    channel[key] = (getter, partial(self.resolve(setter), i), metadata)
+                else:
+                    channel[key] = (getter, metadata)
+            channels.append(channel)
+
+        return channels
 
     def get(self, path, metadata):
-        return self.param_tree.get(path, metadata=metadata)
+        if metadata:
+            return self.param_tree.get(path, metadata=metadata)
+        return self.index.get(path)
+
+    def select(self, fields):
+        # Compact values of the parameters matching a comma-separated list of glob paths
+        return self.index.select(fields.split(','))
 
     def set(self, path, value):
-        self.param_tree.set(path, value)
+        self.write_count += 1
+        self.index.set(path, value)
+
+    def complete_job(self, job=None):
+        # Count completed hardware worker jobs, so that the results of queued writes (e.g.
+        # scans, sweeps and sequences) start a new snapshot once they are visible
+        self.job_count += 1
+
+    def get_current(self, path):
+        # Current state at a path, unwrapped from the response dict
+        levels = [level for level in path.split('/') if level]
+        response = self.index.get(path)
+        return response[levels[-1]] if levels else response
+
+    def is_parameter(self, path):
+        # Whether a path addresses a single parameter rather than a branch of the tree
+        return path.strip('/') in self.index.leaves
+
+    def check_precondition(self, path, value, expect):
+        # Check that the current state matches expect, returning the values which would
+        # change the state, or None if the write would not change it
+        path = path.strip('/')
+        current = self.get_current(path)
+        if not _matches(expect, current, path, self.index.leaves):
+            raise PreconditionError(
+                "Current value of {} does not match expected value".format(path or '/'))
+
+        return _prune(value, current, path, self.index.leaves)
+
+    def compare_and_set(self, path, value, expect):
+        # Set the value only if the current state matches expect, skipping any
+        # writes which would not change the state. Returns True if a write was made.
+        value = self.check_precondition(path, value, expect)
+        if value is None:
+            return False
+
+        self.write_count += 1
+        self.index.set(path, value)
+        return True
@@ -0,0 +1,81 @@
+"""ChannelStore - compact array-backed store of the backplane channel state.
+
+This class holds the per-channel state of the backplane (current/voltage readings and
+their deadbands, power good inputs and variable resistor values) as a struct of arrays,
+replacing a wrapper object per channel. Numeric state is held in typed arrays, so each
+channel costs a few bytes rather than an object, a parameter tree and bound methods.
+
+The CHANNEL_SCHEMA describes the fields of each channel group, from which the parameter
+tree is generated by BackplaneData.
+
+James Hogge, STFC Application Engineering Group.
+"""
+
+from array import array
+
+
+class ChannelStore(object):
+    """ChannelStore class.
+
+    This class implements a fixed-size struct-of-arrays store of the backplane channels.
+    """
+
+    __slots__ = (
+        'currents', 'voltages', 'raw_currents', 'raw_voltages',
+        'current_deadbands', 'voltage_deadbands', 'deadband_relative', 'changed_counts',
+        'power_good', 'resistors',
+    )
+
+    NUM_ADC_CHANNELS = 13
+    NUM_POWER_GOOD = 8
+    NUM_RESISTORS = 7
+
+    def __init__(self):
+        """Initialise the ChannelStore with zeroed channel state."""
+        adc_zeros = [0.0] * self.NUM_ADC_CHANNELS
+
+        # Published and raw current/voltage readings
+        self.currents = array('d', adc_zeros)
+        self.voltages = array('d', adc_zeros)
+        self.raw_currents = array('d', adc_zeros)
+        self.raw_voltages = array('d', adc_zeros)
+
+        # Deadbands and update count of the snapshot in which each channel was last published
+        self.current_deadbands = array('d', adc_zeros)
+        self.voltage_deadbands = array('d', adc_zeros)
+        self.deadband_relative = [False] * self.NUM_ADC_CHANNELS
+        self.changed_counts = array('L', [0] * self.NUM_ADC_CHANNELS)
+
+        # Boolean states are kept as lists so that they read back as bools
+        self.power_good = [False] * self.NUM_POWER_GOOD
+
+        self.resistors = array('d', [0.0] * self.NUM_RESISTORS)
+
+
+# Schema of the channel groups in the parameter tree. Each group maps to a tuple of
+# (number of channels, name accessor, fields), where each field is a tuple of
+# (key, source, setter, metadata). Accessors are named by their dotted attribute path
+# relative to the BackplaneData instance. A source is either a ChannelStore array, read
+# by channel index, or a method taking the channel index. A setter is a method taking
+# the channel index and value, or None if the field is read-only. Metadata values
+# prefixed by '@' name a method taking the channel index.
+CHANNEL_SCHEMA = {
+    "current_voltage": (ChannelStore.NUM_ADC_CHANNELS, "backplane.get_adc_name", [
+        ("current", "store.currents", None, {"units": "mA"}),
+        ("voltage", "store.voltages", None, {"units": "V"}),
+        ("sample_rate", "scheduler.get_rate", None,
+         {"units": "Hz", "description": "Effective sample rate of the channel"}),
+        ("current_deadband", "store.current_deadbands", "backplane.set_current_deadband",
+         {"description": "Change in current needed to publish a reading, in mA or relative"}),
+        ("voltage_deadband", "store.voltage_deadbands", "backplane.set_voltage_deadband",
+         {"description": "Change in voltage needed to publish a reading, in V or relative"}),
+        ("deadband_relative", "store.deadband_relative", "backplane.set_deadband_relative",
+         {"description": "Deadbands are fractions of the published value"}),
+        ("changed", "backplane.get_changed", None,
+         {"description": "Reading changed in the current snapshot"}),
+    ]),
+    "resistors": (ChannelStore.NUM_RESISTORS, "backplane.get_resistor_name", [
+        ("value", "store.resistors", "backplane.set_resistor_value",
+         {"units": "@backplane.get_resistor_units"}),
+    ]),
+}
@@ -0,0 +1,106 @@
+"""DeviceStateStore - persisted shadow register state of the backplane devices.
+
+This class saves the shadow register state of the backplane I2C devices (e.g. TPL0102
+wiper positions and MCP23008 direction and pullup registers) to a small local JSON file,
+so that on restart each device can verify its saved state with a single block read rather
+than reading back each register in turn. A device whose registers do not match its saved
+state falls back to a full resync.
+
+The file holds a CRC32 checksum of the saved state, so that a truncated or corrupted file
+is discarded rather than trusted.
+
+James Hogge, STFC Application Engineering Group.
+"""
+
+import os
+import json
+import zlib
+import logging
+
+
+class DeviceStateStore(object):
+    """DeviceStateStore class.
+
+    This class implements loading and saving of per-device shadow register state.
+    """
+
+    # Version of the state file format
+    VERSION = 1
+
+    def __init__(self, path):
+        """Initialise the DeviceStateStore, loading any saved state.
+
+        :param path: path of the state file, None to disable persistence
+        """
+        self.path = path
+        self.saved = self.load()
+
+    @staticmethod
+    def checksum(devices):
+        """Calculate the checksum of a device state dict.
+
+        :param devices: dict of device states keyed by device name
+        :returns: CRC32 of the canonical JSON serialisation of the states
+        """
+        return zlib.crc32(json.dumps(devices, sort_keys=True).encode('utf-8')) & 0xFFFFFFFF
+
+    def load(self):
+        """Load the saved device states from the state file.
+
+        :returns: dict of device states keyed by device name, empty if the file is missing,
+                  invalid or fails its checksum
+        """
+        if not self.path or not os.path.isfile(self.path):
+            return {}
+
+        try:
+            with open(self.path) as state_file:
+                state = json.load(state_file)
+            devices = state['devices']
+            if (state.get('version') != self.VERSION or
+                    state.get('checksum') != self.checksum(devices)):
+                raise ValueError("version or checksum mismatch")
+        except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning("Ignoring device state file %s: %s", self.path, e)
+            return {}
+
+        return devices
+
+    def get(self, name):
+        """Get the saved state of a device.
+
+        :param name: device name
+        :returns: saved state dict, None if no state was saved for the device
+        """
+        return self.saved.get(name)
+
+    def save(self, devices):
+        """Save the device states to the state file, if they have changed.
+
+        The states are merged into those saved, so that the states of devices which have not
+        yet been set up (e.g. part way through initialisation) are kept for them to verify.
+        The file is written to a temporary file and renamed into place, so that an
+        interrupted write leaves the previous state intact.
+
+        :param devices: dict of device states keyed by device name
+        """
+        devices = dict(self.saved, **devices)
+        if not self.path or devices == self.saved:
+            return
+
+        state = {
+            'version': self.VERSION,
+            'checksum': self.checksum(devices),
+            'devices': devices,
+        }
+
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'w') as state_file:
+                json.dump(state, state_file, sort_keys=True)
+            os.rename(temp_path, self.path)
+        except (IOError, OSError) as e:
+            logging.warning("Failed to save device state file %s: %s", self.path, e)
+            return
+
+        self.saved = devices
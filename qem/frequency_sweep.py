@@ -0,0 +1,147 @@
+"""FrequencySweep - SI570 clock frequency sweeps with synchronised sensor capture.
+
+This class steps the SI570 clock through a list of frequencies, waiting a settle time at
+each point and then capturing the readings of a set of backplane current/voltage
+channels.
+
+Sweeps are specified as dicts, either as a range or a list of frequencies, e.g.:
+
+    {"start": 20.0, "stop": 22.0, "step": 0.01, "settle": 0.1,
+     "channels": ["VDDO", "VDD_D18ADC"]}
+
+    {"frequencies": [10.0, 21.0, 100.0], "settle": 0.5, "channels": [3, 4]}
+
+Channels may be given by name or index and default to all channels. The register images
+for every point are solved before the sweep starts, so that each point costs only the bus
+writes; points close together are set by glitch-free small steps. The clock is restored to
+its original frequency afterwards unless "restore" is false.
+
+The readings are recorded into a table with a row for each point, of the columns listed
+in the sweep results: the frequency, capture time and settling time of the point, then
+the current and voltage of each channel. The settling time is zero unless the settle is
+"auto".
+
+James Hogge, STFC Application Engineering Group.
+"""
+
+import time
+from array import array
+
+from sensor_capture import SensorCapture
+
+
+class SweepError(Exception):
+    """Simple exception class for errors in frequency sweeps."""
+
+    pass
+
+
+class FrequencySweep(SensorCapture):
+    """FrequencySweep class.
+
+    This class implements frequency sweeps of the backplane SI570 clock.
+    """
+
+    name = "sweep"
+    error = SweepError
+
+    # Maximum number of points in a sweep
+    MAX_POINTS = 10000
+
+    # Columns recorded for each point, followed by the fields of each channel
+    COLUMNS = ["frequency", "time", "settling"]
+    FIELDS = ["current", "voltage"]
+
+    def get_frequencies(self, spec):
+        """Get the list of frequencies specified for a sweep.
+
+        :param spec: sweep dict
+        :returns: list of frequencies (MHz)
+        """
+        if "frequencies" in spec:
+            frequencies = [float(freq) for freq in spec["frequencies"]]
+        elif all(key in spec for key in ("start", "stop", "step")):
+            start, stop, step = float(spec["start"]), float(spec["stop"]), float(spec["step"])
+            if step == 0 or (stop - start) / step < 0:
+                raise SweepError("Sweep step must be non-zero and towards the stop frequency")
+            # Allow for rounding so that the stop frequency is included when on a step
+            count = int((stop - start) / step + 1e-9) + 1
+            if count > self.MAX_POINTS:
+                raise SweepError("Sweep exceeds {} points".format(self.MAX_POINTS))
+            frequencies = [start + i * step for i in range(count)]
+        else:
+            raise SweepError("A sweep requires frequencies or start, stop and step")
+
+        if not frequencies:
+            raise SweepError("A sweep requires at least one frequency")
+        if len(frequencies) > self.MAX_POINTS:
+            raise SweepError("Sweep exceeds {} points".format(self.MAX_POINTS))
+
+        return frequencies
+
+    def get_channels(self, spec):
+        """Get the indices of the channels to capture in a sweep.
+
+        :param spec: sweep dict
+        :returns: list of channel indices
+        """
+        try:
+            return [self.backplane.get_adc_channel(channel)
+                    for channel in spec.get("channels", self.backplane.ADC_CHANNELS)]
+        except ValueError as e:
+            raise SweepError(str(e))
+
+    def run(self, spec):
+        """Run a frequency sweep.
+
+        :param spec: sweep dict
+        """
+        if not isinstance(spec, dict):
+            raise SweepError("A sweep must be a dict")
+
+        frequencies = self.get_frequencies(spec)
+        channels = self.get_channels(spec)
+        settle = self.get_settle(spec)
+        restore = bool(spec.get("restore", True))
+
+        backplane = self.backplane
+        backplane.si570.precompute(frequencies)
+
+        names = [backplane.get_adc_name(i) for i in channels]
+        columns = self.COLUMNS + ["{}/{}".format(name, field)
+                                  for name in names for field in self.FIELDS]
+        results = self.results = {
+            "channels": names,
+            "columns": columns,
+            "shape": [0, len(columns)],
+            "points": 0,
+            "paths": {},
+        }
+
+        # Readings are appended row by row to a flat table of doubles
+        data = array('d')
+        original_freq = backplane.get_clock_frequency()
+
+        # The sweep makes its own settling waits, so the wait made by the backplane after each
+        # clock change is suspended to avoid waiting twice at every point
+        settling_enabled = backplane.settling.get_enabled()
+        backplane.settling.set_enabled(False)
+
+        def restore_hardware():
+            backplane.settling.set_enabled(settling_enabled)
+            if restore:
+                backplane.set_clock_frequency(original_freq)
+
+        with self.capture(data, restore_hardware) as start_time:
+            for freq in frequencies:
+                backplane.set_clock_frequency(freq)
+                path = backplane.get_clock_path()
+                settling = self.settle(settle, "clock", channels)
+
+                backplane.poll_channels(channels)
+                data.extend((freq, time.time() - start_time, settling))
+                for i in channels:
+                    data.extend((backplane.raw_currents[i], backplane.raw_voltages[i]))
+                results["paths"][path] = results["paths"].get(path, 0) + 1
+                results["points"] += 1
+                results["shape"][0] = results["points"]
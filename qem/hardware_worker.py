@@ -0,0 +1,164 @@
+"""HardwareWorker - background execution of slow hardware operations.
+
+This class implements a worker thread which executes queued hardware operations (e.g.
+programming the SI570 or writing TPL0102 non-volatile registers) outside the tornado
+IOLoop, holding the backplane bus lock for the duration of each operation. Each queued
+operation is tracked as a Job, the status of which can be queried by its id.
+
+James Hogge, STFC Application Engineering Group.
+"""
+
+import time
+import logging
+import threading
+import Queue
+from collections import OrderedDict
+
+
+class Job(object):
+    """Job class.
+
+    This class is a simple container for a queued hardware operation and its status.
+    """
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, job_id, description, func, *args, **kwargs):
+        """Initialise the Job.
+
+        :param job_id: unique id of the job
+        :param description: printable description of the job, e.g. the request path
+        :param func: callable performing the operation, the return value is the job result
+        :param args: positional arguments to pass to func
+        :param kwargs: keyword arguments to pass to func
+        """
+        self.id = job_id
+        self.description = description
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+        self.status = self.QUEUED
+        self.result = None
+        self.error = None
+        self.queued_time = time.time()
+        self.start_time = None
+        self.end_time = None
+
+    def execute(self):
+        """Execute the job, recording its result or error."""
+        self.status = self.RUNNING
+        self.start_time = time.time()
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+            self.status = self.DONE
+        except Exception as e:
+            logging.error("Job %d (%s) failed: %s", self.id, self.description, e)
+            self.error = str(e)
+            self.status = self.FAILED
+        self.end_time = time.time()
+
+    def to_dict(self):
+        """Get a dict representation of the job status.
+
+        :returns: dict of job status, result and timing
+        """
+        return {
+            "id": self.id,
+            "description": self.description,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "queued": self.queued_time,
+            "started": self.start_time,
+            "finished": self.end_time,
+        }
+
+
+class HardwareWorker(object):
+    """HardwareWorker class.
+
+    This class implements a single worker thread which executes queued jobs in order while
+    holding the bus lock.
+    """
+
+    # Number of completed jobs retained for status queries
+    MAX_JOBS = 100
+
+    def __init__(self, lock, on_complete=None):
+        """Initialise the HardwareWorker and start its thread.
+
+        :param lock: lock serialising access to the hardware
+        :param on_complete: optional callable passed each job once it has executed, called
+                            while holding the lock
+        """
+        self.lock = lock
+        self.on_complete = on_complete
+        self.queue = Queue.Queue()
+        self.jobs = OrderedDict()
+        self.next_id = 1
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, description, func, *args, **kwargs):
+        """Queue a job for execution by the worker.
+
+        :param description: printable description of the job
+        :param func: callable performing the operation
+        :param args: positional arguments to pass to func
+        :param kwargs: keyword arguments to pass to func
+        :returns: the queued Job
+        """
+        job = Job(self.next_id, description, func, *args, **kwargs)
+        self.next_id += 1
+
+        # Discard the oldest finished jobs once the retention limit is reached
+        while len(self.jobs) >= self.MAX_JOBS:
+            oldest = next(iter(self.jobs.values()))
+            if oldest.status in (Job.QUEUED, Job.RUNNING):
+                break
+            self.jobs.popitem(last=False)
+
+        self.jobs[job.id] = job
+        self.queue.put(job)
+        return job
+
+    def get_job(self, job_id):
+        """Get a job by id.
+
+        :param job_id: id of the job
+        :returns: Job instance, None if no job with that id is retained
+        """
+        return self.jobs.get(job_id)
+
+    def get_jobs(self):
+        """Get the status of all retained jobs.
+
+        :returns: list of job status dicts
+        """
+        return [job.to_dict() for job in self.jobs.values()]
+
+    def pending(self):
+        """Return the number of jobs waiting to be executed."""
+        return self.queue.qsize()
+
+    def stop(self):
+        """Stop the worker thread after any queued jobs have executed."""
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        """Worker thread loop, executing jobs until stopped."""
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            with self.lock:
+                job.execute()
+                if self.on_complete is not None:
+                    self.on_complete(job)
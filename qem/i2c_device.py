@@ -23,9 +23,11 @@ class I2CException(Exception):
 def call_pre_access(func):
     """Call pre-access decorator for I2CDevice access methods.
 
-    Allows pre-access attribute to be called if defined on I2C device accessors.
+    Allows pre-access attribute to be called if defined on I2C device accessors. Each
+    access is also counted in the I2CDevice transaction count.
     """
     def wrapper(_self, *args, **kwargs):
+        I2CDevice.transaction_count += 1
         if _self.pre_access is not None and callable(_self.pre_access):
             _self.pre_access(_self)
         return func(_self, *args, **kwargs)
@@ -45,6 +47,9 @@ class I2CDevice(object):
 
     ERROR = -1
 
+    # Count of bus accesses made by all devices, allowing the cost of operations to be measured
+    transaction_count = 0
+
     @classmethod
     def enable_exceptions(cls):
         """Enable I2CDevice exceptions."""
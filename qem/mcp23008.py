@@ -33,19 +33,49 @@ class MCP23008(I2CDevice):
     LOW = 0
     HIGH = 1
 
-    def __init__(self, address=0x20, **kwargs):
+    def __init__(self, address=0x20, state=None, **kwargs):
         """Initialise the MCP23008 device.
 
         :param address: address of the MCP23008 deviceon the I2C bus
+        :param state: saved buffered register state from get_state(), verified against the
+                      device with a single block read rather than reading each register
         :param kwargs: keyword arguments to be passed to the underlying I2CDevice
         """
         # Initialise the I2CDevice superclass instance
         I2CDevice.__init__(self, address, **kwargs)
 
         # Synchronise local buffered register values with state of device
-        self.__iodir = self.readU8(self.IODIR)
-        self.__gppu = self.readU8(self.GPPU)
-        self.__gpio = self.readU8(self.GPIO)
+        if not (state and self.restore_state(state)):
+            self.__iodir = self.readU8(self.IODIR)
+            self.__gppu = self.readU8(self.GPPU)
+            self.__gpio = self.readU8(self.GPIO)
+
+    def get_state(self):
+        """Get the buffered register state of the device.
+
+        :return dict of the buffered IODIR and GPPU register values
+        """
+        return {"iodir": self.__iodir, "gppu": self.__gppu}
+
+    def restore_state(self, state):
+        """Restore saved buffered register state if it matches the device.
+
+        The IODIR to GPIO registers are read in a single block read, and the saved IODIR and
+        GPPU values are compared against the device. The GPIO register is always taken from
+        the device, since it reflects the state of the input pins.
+
+        :param state: state from get_state()
+        :return True if the state matched and was restored, False otherwise
+        """
+        data = self.readList(self.IODIR, self.GPIO - self.IODIR + 1)
+        if data == I2CDevice.ERROR or \
+                [data[self.IODIR], data[self.GPPU]] != [state.get("iodir"), state.get("gppu")]:
+            return False
+
+        self.__iodir = data[self.IODIR]
+        self.__gppu = data[self.GPPU]
+        self.__gpio = data[self.GPIO]
+        return True
 
     def setup(self, pin, direction):
         """Set the IO direction state of a pin.
@@ -56,6 +86,7 @@ class MCP23008(I2CDevice):
         :param direction: direction to set
         """
         # Set direction in register buffer value
+        iodir = self.__iodir
         if direction == self.IN:
             self.__iodir |= 1 << pin
         elif direction == self.OUT:
@@ -65,8 +96,9 @@ class MCP23008(I2CDevice):
                 "MCP23008::setup() expected a direction of MCP23008.IN or MCP23008.OUT"
             )
 
-        # Write the state to the IODIR register
-        self.write8(self.IODIR, self.__iodir)
+        # Write the state to the IODIR register if it has changed
+        if self.__iodir != iodir:
+            self.write8(self.IODIR, self.__iodir)
 
     def pullup(self, pin, enabled):
         """Set the pullup state of a pin.
@@ -104,11 +136,22 @@ class MCP23008(I2CDevice):
         :return list of bool states of pins requested
         """
         # Read the GPIO register
-        buff = self.readU8(self.GPIO)
+        buff = self.input_mask()
 
         # Buils and return a list of input states for the requested pins
         return [bool(buff & (1 << pin)) for pin in pins]
 
+    def input_mask(self):
+        """Get the input state of all pins as a bit mask.
+
+        This method returns the GPIO register of the device, with bit n holding the state
+        of pin n. Unlike input_pins, no list is built, allowing callers polling at a high
+        rate to test for changes without allocating.
+
+        :return int GPIO register value
+        """
+        return self.readU8(self.GPIO)
+
     def output(self, pin, value):
         """Set the output state of a pin.
 
@@ -0,0 +1,187 @@
+"""PathIndex - flat path-to-accessor index for a parameter tree.
+
+This class precompiles a parameter tree specification into a flat index mapping each full
+path to its accessors, so that a leaf parameter is resolved with a single dict lookup
+rather than splitting the path and walking nested dicts and lists on every request.
+Subtrees are assembled from precomputed lists of child paths.
+
+The shape of the index mirrors the rendering of the equivalent MetadataTree (which is
+still used for requests including metadata), so that responses are identical.
+
+James Hogge, STFC Application Engineering Group.
+"""
+
+from fnmatch import fnmatchcase
+
+from odin.adapters.metadata_tree import MetadataParameterError
+
+
+class PathIndex(object):
+    """PathIndex class.
+
+    This class implements get and set access to a parameter tree through a flat index of
+    leaf accessors and branch child lists.
+    """
+
+    # Maximum number of selection patterns cached
+    MAX_SELECTIONS = 64
+
+    def __init__(self, spec, rendered):
+        """Initialise the PathIndex.
+
+        :param spec: parameter tree specification, as passed to MetadataTree
+        :param rendered: the MetadataTree rendering of the spec without metadata, used to
+                         determine which keys are parameters and which are list nodes
+        """
+        # Leaf paths mapped to (getter, setter, metadata) triples
+        self.leaves = {}
+        # Branch paths mapped to (is_list, [(key, child path), ...])
+        self.branches = {}
+        # All paths in tree order, used to match selection patterns
+        self.paths = []
+        # Cache of selection patterns mapped to the paths they match
+        self.selections = {}
+
+        self._build(spec, rendered, '')
+
+    def _build(self, spec, rendered, path):
+        """Recursively add a node of the specification to the index.
+
+        :param spec: specification of the node
+        :param rendered: rendering of the node
+        :param path: full path of the node
+        """
+        if path:
+            self.paths.append(path)
+
+        if isinstance(spec, (dict, list)) and isinstance(rendered, (dict, list)):
+            if isinstance(rendered, list):
+                keys = [str(i) for i in range(len(rendered))]
+                values = rendered
+            else:
+                keys = sorted(rendered.keys())
+                values = [rendered[key] for key in keys]
+
+            children = []
+            for key, value in zip(keys, values):
+                child_path = path + '/' + key if path else key
+                child_spec = spec[int(key)] if isinstance(spec, list) else spec[key]
+                self._build(child_spec, value, child_path)
+                children.append((key, child_path))
+
+            self.branches[path] = (isinstance(rendered, list), children)
+            return
+
+        getter, setter, metadata = None, None, {}
+        if isinstance(spec, tuple):
+            if isinstance(spec[-1], dict):
+                metadata = spec[-1]
+                spec = spec[:-1]
+            getter = spec[0]
+            if len(spec) > 1:
+                setter = spec[1]
+        else:
+            getter = spec
+
+        if not callable(getter):
+            getter = (lambda value: lambda: value)(getter)
+
+        self.leaves[path] = (getter, setter, metadata)
+
+    def _render(self, path):
+        """Render the current values of the node at a path.
+
+        :param path: normalised full path of the node
+        :returns: value of a leaf, or a dict or list of values for a branch
+        """
+        leaf = self.leaves.get(path)
+        if leaf is not None:
+            return leaf[0]()
+
+        is_list, children = self.branches[path]
+        if is_list:
+            return [self._render(child_path) for _, child_path in children]
+        return {key: self._render(child_path) for key, child_path in children}
+
+    def get(self, path):
+        """Get the values of the parameters at a path.
+
+        :param path: path in the tree
+        :returns: dict of the values at the path, keyed by the last level of the path
+        """
+        path = path.strip('/')
+        if path not in self.leaves and path not in self.branches:
+            raise MetadataParameterError("Invalid path: {}".format(path))
+
+        if not path:
+            return self._render(path)
+        return {path.rsplit('/', 1)[-1]: self._render(path)}
+
+    def select(self, patterns):
+        """Get the values of the parameters matching a list of glob patterns.
+
+        Patterns are matched level by level, so that e.g. current_voltage/*/current matches
+        the current of every channel. A pattern matching a branch selects the whole subtree.
+
+        :param patterns: list of glob patterns
+        :returns: dict of values keyed by the full path of each matching parameter
+        """
+        patterns = tuple(pattern.strip('/') for pattern in patterns)
+        paths = self.selections.get(patterns)
+        if paths is None:
+            split_patterns = [pattern.split('/') for pattern in patterns]
+            paths = []
+            for path in self.paths:
+                levels = path.split('/')
+                for pattern in split_patterns:
+                    if len(pattern) == len(levels) and all(
+                            fnmatchcase(level, match) for level, match in zip(levels, pattern)):
+                        paths.append(path)
+                        break
+
+            if not paths:
+                raise MetadataParameterError("No parameters match {}".format(','.join(patterns)))
+
+            if len(self.selections) >= self.MAX_SELECTIONS:
+                self.selections.clear()
+            self.selections[patterns] = paths
+
+        return {path: self._render(path) for path in paths}
+
+    def set(self, path, data):
+        """Set the values of the parameters at a path.
+
+        All leaf paths addressed by the data are resolved before any are written, so an
+        invalid path or read-only parameter results in no writes.
+
+        :param path: path in the tree
+        :param data: value for a leaf path, or nested dict of values for a branch
+        """
+        writes = []
+        self._resolve(path.strip('/'), data, writes)
+        for setter, value in writes:
+            setter(value)
+
+    def _resolve(self, path, data, writes):
+        """Recursively resolve the setters for the values in data.
+
+        :param path: normalised full path the data is addressed to
+        :param data: value or nested dict of values
+        :param writes: list to append (setter, value) pairs to
+        """
+        leaf = self.leaves.get(path)
+        if leaf is not None:
+            if leaf[1] is None:
+                raise MetadataParameterError("Parameter {} is read-only".format(path))
+            writes.append((leaf[1], data))
+            return
+
+        if path not in self.branches:
+            raise MetadataParameterError("Invalid path: {}".format(path))
+        if isinstance(data, list):
+            data = {str(i): value for i, value in enumerate(data)}
+        if not isinstance(data, dict):
+            raise MetadataParameterError("Invalid value for {}: {}".format(path or '/', data))
+
+        for key, value in data.items():
+            self._resolve(path + '/' + key if path else key, value, writes)
@@ -0,0 +1,103 @@
+"""Poll benchmark - allocation regression check for the backplane poll loop.
+
+This module measures the memory allocated by steady-state backplane poll cycles using
+tracemalloc. After a warm-up period, in which caches and buffers are populated, the net
+allocation per cycle should be close to zero, since readings are written into preallocated
+buffers. Running the module on the target fails if the net allocation exceeds a limit, so
+that regressions in the poll path are caught:
+
+    python -m qem.poll_benchmark --cycles 1000
+
+tracemalloc is part of the standard library from Python 3.4, and is available for Python 2
+as the pytracemalloc package.
+
+James Hogge, STFC Application Engineering Group.
+"""
+
+import argparse
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+# Net bytes allocated per cycle above which the poll loop is considered to be allocating
+MAX_BYTES_PER_CYCLE = 8.0
+
+
+def measure_poll_allocations(poll, cycles=1000, warmup=50):
+    """Measure the net memory allocated by repeated poll cycles.
+
+    :param poll: callable performing one poll cycle, e.g. Backplane.poll_all_sensors
+    :param cycles: number of cycles measured
+    :param warmup: number of cycles run before measurement starts
+    :returns: dict of the cycles measured, net bytes and blocks allocated, bytes per cycle,
+              peak traced memory and mean cycle time
+    """
+    if tracemalloc is None:
+        raise RuntimeError("tracemalloc is not available, install pytracemalloc on Python 2")
+
+    for _ in range(warmup):
+        poll()
+
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        start = time.time()
+        for _ in range(cycles):
+            poll()
+        elapsed = time.time() - start
+        after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    stats = after.compare_to(before, 'filename')
+    net_bytes = sum(stat.size_diff for stat in stats)
+    net_blocks = sum(stat.count_diff for stat in stats)
+
+    return {
+        "cycles": cycles,
+        "net_bytes": net_bytes,
+        "net_blocks": net_blocks,
+        "bytes_per_cycle": float(net_bytes) / cycles,
+        "peak_bytes": peak,
+        "cycle_time": elapsed / cycles,
+    }
+
+
+def main(argv=None):
+    """Run the poll allocation benchmark against the backplane.
+
+    :param argv: command line arguments, defaulting to sys.argv
+    :returns: exit status, non-zero if the poll loop exceeded the allocation limit
+    """
+    parser = argparse.ArgumentParser(description="Check the backplane poll loop for allocations")
+    parser.add_argument('--cycles', type=int, default=1000, help="number of cycles measured")
+    parser.add_argument('--warmup', type=int, default=50, help="number of warm-up cycles")
+    parser.add_argument('--limit', type=float, default=MAX_BYTES_PER_CYCLE,
+                        help="maximum net bytes allocated per cycle")
+    args = parser.parse_args(argv)
+
+    from backplane import Backplane
+    backplane = Backplane()
+    backplane.initialise()
+
+    result = measure_poll_allocations(backplane.poll_all_sensors, args.cycles, args.warmup)
+    for key in sorted(result):
+        print("{}: {}".format(key, result[key]))
+
+    if result["bytes_per_cycle"] > args.limit:
+        print("FAIL: {:.1f} bytes allocated per cycle exceeds limit of {:.1f}".format(
+            result["bytes_per_cycle"], args.limit))
+        return 1
+
+    print("PASS")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
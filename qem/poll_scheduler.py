@@ -0,0 +1,122 @@
+"""AdaptivePollScheduler - activity-driven per-channel sample rates for the backplane.
+
+This class schedules polling of the backplane current/voltage channels at individual
+rates driven by their activity. Each channel tracks the change in its readings between
+samples, normalised to a threshold fraction of its full-scale range. A channel whose
+readings change by more than the threshold is promoted to the maximum rate (the adapter
+update interval), while a channel which stays stable has its sample period doubled after
+each sample, down to a floor rate. Bus time is thereby spent on the channels which are
+changing.
+
+The scheduler also tracks how the adapter update loop is running, i.e. whether adaptive
+polling is enabled and the interval of the loop (which drops to the idle interval when
+on-demand polling is idle), so that the sample rates reported are those actually in use.
+
+James Hogge, STFC Application Engineering Group.
+"""
+
+import time
+
+
+class AdaptivePollScheduler(object):
+    """AdaptivePollScheduler class.
+
+    This class implements adaptive per-channel scheduling of backplane sensor polls.
+    """
+
+    # Weight of the latest sample in the exponentially weighted activity average
+    ACTIVITY_WEIGHT = 0.25
+
+    def __init__(self, backplane, min_period, max_period=1.0, threshold=0.002):
+        """Initialise the AdaptivePollScheduler.
+
+        :param backplane: Backplane instance to poll
+        :param min_period: sample period of active channels (seconds)
+        :param max_period: sample period stable channels fall back to (seconds)
+        :param threshold: change between samples, as a fraction of a channel's full-scale
+                          range, above which the channel is considered active
+        """
+        self.backplane = backplane
+        self.min_period = float(min_period)
+        self.max_period = max(float(max_period), self.min_period)
+        self.threshold = float(threshold)
+
+        num_channels = len(backplane.currents)
+        self.periods = [self.min_period] * num_channels
+        self.next_poll = [0.0] * num_channels
+        self.activity = [0.0] * num_channels
+        self.last_current = list(backplane.raw_currents)
+        self.last_voltage = list(backplane.raw_voltages)
+        # Adaptive polling enabled and the interval the update loop is running at
+        self.enabled = True
+        self.interval = self.min_period
+        # Incremented whenever a sample period changes, identifying the state of the rates
+        self.revision = 0
+
+    def set_polling(self, enabled, interval):
+        """Set how the update loop is polling the channels.
+
+        :param enabled: adaptive polling is enabled, otherwise all channels are polled on
+                        each cycle
+        :param interval: interval of the update loop (seconds)
+        """
+        enabled = bool(enabled)
+        interval = float(interval)
+        if (enabled, interval) != (self.enabled, self.interval):
+            self.enabled = enabled
+            self.interval = interval
+            self.revision += 1
+
+    def get_rate(self, channel):
+        """Get the effective sample rate of a channel.
+
+        A channel cannot be sampled more often than the update loop runs, and every channel
+        is sampled on each cycle when adaptive polling is disabled.
+
+        :param channel: channel index
+        :returns: sample rate (Hz)
+        """
+        if not self.enabled:
+            return 1.0 / self.interval
+        return 1.0 / max(self.periods[channel], self.interval)
+
+    def poll(self):
+        """Poll the channels which are due and update their sample periods."""
+        now = time.time()
+
+        # Allow for jitter in the update loop so that active channels are polled every cycle
+        due = [i for i, next_poll in enumerate(self.next_poll)
+               if next_poll - now <= self.min_period / 2]
+        self.backplane.poll_channels(due)
+
+        for i in due:
+            self._update_period(i)
+            self.next_poll[i] = now + self.periods[i]
+
+    def _update_period(self, i):
+        """Update the sample period of a channel from its latest sample.
+
+        :param i: channel index
+        """
+        current = self.backplane.raw_currents[i]
+        voltage = self.backplane.raw_voltages[i]
+
+        # Change since the last sample, in units of the activity threshold
+        change = max(
+            abs(current - self.last_current[i]) / self.backplane.CURRENT_MULTIPLIERS[i],
+            abs(voltage - self.last_voltage[i]) / self.backplane.VOLTAGE_MULTIPLIERS[i]
+        ) / self.threshold
+
+        self.last_current[i] = current
+        self.last_voltage[i] = voltage
+        self.activity[i] += self.ACTIVITY_WEIGHT * (change - self.activity[i])
+
+        period = self.periods[i]
+        if change > 1.0:
+            period = self.min_period
+        elif self.activity[i] < 0.5:
+            period = min(period * 2, self.max_period)
+
+        if period != self.periods[i]:
+            self.periods[i] = period
+            self.revision += 1
@@ -0,0 +1,153 @@
+"""PollTiming - poll loop timing statistics and garbage collection management.
+
+This class measures the timing of the adapter poll loop: the duration of each poll cycle and
+the jitter between the time a cycle was scheduled to start and the time it started. It also
+records the pauses caused by the cyclic garbage collector.
+
+In managed mode, long-lived objects are frozen after startup (where supported) and automatic
+collection is disabled, so that the collector cannot pause a poll cycle part way through.
+Instead, collections are run in the idle gap after each cycle, using the same generation
+thresholds as the automatic collector, and timed. Python 2 has no gc.freeze, so there a full
+collection is run at startup, leaving the long-lived objects in the oldest generation where
+they are rarely traversed.
+
+James Hogge, STFC Application Engineering Group.
+"""
+
+import gc
+import time
+
+
+class PollTiming(object):
+    """PollTiming class.
+
+    This class implements poll cycle jitter and duration statistics and optional management
+    of garbage collection between poll cycles.
+    """
+
+    def __init__(self, managed_gc=False):
+        """Initialise the PollTiming instance.
+
+        :param managed_gc: disable automatic garbage collection and collect between cycles
+        """
+        self.managed_gc = managed_gc
+
+        self.expected_start = None
+        self.cycle_start = 0.0
+
+        self.cycles = 0
+        self.cycle_time = 0.0
+        self.cycle_time_max = 0.0
+        self.jitter = 0.0
+        self.jitter_total = 0.0
+        self.jitter_max = 0.0
+
+        self.gc_collections = 0
+        self.gc_pause = 0.0
+        self.gc_pause_total = 0.0
+        self.gc_pause_max = 0.0
+        self.gc_start = None
+
+        # Time automatic collections where the interpreter reports them (Python 3.3+)
+        if not managed_gc and hasattr(gc, 'callbacks'):
+            gc.callbacks.append(self.gc_callback)
+
+    def start_gc_management(self):
+        """Freeze long-lived objects and disable automatic garbage collection.
+
+        This should be called once startup has created the long-lived objects, e.g. the
+        backplane and parameter tree. It has no effect unless managed mode is enabled.
+        """
+        if not self.managed_gc:
+            return
+
+        gc.collect()
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+        gc.disable()
+
+    def schedule(self, interval):
+        """Record when the next poll cycle is scheduled to start.
+
+        :param interval: time until the next cycle (seconds)
+        """
+        self.expected_start = time.time() + interval
+
+    def start_cycle(self):
+        """Record the start of a poll cycle, updating the jitter statistics."""
+        self.cycle_start = time.time()
+        if self.expected_start is not None:
+            self.jitter = abs(self.cycle_start - self.expected_start)
+            self.jitter_total += self.jitter
+            self.jitter_max = max(self.jitter_max, self.jitter)
+
+    def end_cycle(self):
+        """Record the end of a poll cycle, updating the cycle time statistics."""
+        self.cycles += 1
+        self.cycle_time = time.time() - self.cycle_start
+        self.cycle_time_max = max(self.cycle_time_max, self.cycle_time)
+
+    def collect(self):
+        """Run any garbage collection due, if in managed mode.
+
+        This should be called in the idle gap after a poll cycle. The oldest generation whose
+        allocation count has reached its threshold is collected, as the automatic collector
+        would have done during the cycle.
+        """
+        if not self.managed_gc:
+            return
+
+        generation = None
+        for gen, (count, threshold) in enumerate(zip(gc.get_count(), gc.get_threshold())):
+            if threshold and count >= threshold:
+                generation = gen
+        if generation is None:
+            return
+
+        start = time.time()
+        gc.collect(generation)
+        self.record_gc_pause(time.time() - start)
+
+    def gc_callback(self, phase, info):
+        """Time automatic garbage collections.
+
+        :param phase: 'start' or 'stop'
+        :param info: dict of information about the collection
+        """
+        if phase == 'start':
+            self.gc_start = time.time()
+        elif self.gc_start is not None:
+            self.record_gc_pause(time.time() - self.gc_start)
+            self.gc_start = None
+
+    def record_gc_pause(self, pause):
+        """Record the duration of a garbage collection.
+
+        :param pause: duration of the collection (seconds)
+        """
+        self.gc_collections += 1
+        self.gc_pause = pause
+        self.gc_pause_total += pause
+        self.gc_pause_max = max(self.gc_pause_max, pause)
+
+    def get_stats(self):
+        """Get the poll timing and garbage collection statistics.
+
+        :returns: dict of statistics, times in seconds
+        """
+        return {
+            "cycles": self.cycles,
+            "cycle_time": self.cycle_time,
+            "cycle_time_max": self.cycle_time_max,
+            "jitter": self.jitter,
+            "jitter_mean": self.jitter_total / self.cycles if self.cycles else 0.0,
+            "jitter_max": self.jitter_max,
+            "gc": {
+                "managed": self.managed_gc,
+                "enabled": gc.isenabled(),
+                "collections": self.gc_collections,
+                "pause": self.gc_pause,
+                "pause_total": self.gc_pause_total,
+                "pause_max": self.gc_pause_max,
+            },
+        }
@@ -0,0 +1,169 @@
+"""ProfileManager - named board configuration profiles for the QEM backplane.
+
+This class allows the backplane to be switched between standard operating points
+(resistor values, SI570 clock frequency and PSU enable) stored as JSON profile files.
+Applying a profile compares it against the current backplane state and only writes
+the settings which differ, reporting the bus transactions and time taken.
+
+A profile file contains any subset of the following fields, e.g.:
+
+    {
+        "description": "Nominal operating point",
+        "clock": 21.0,
+        "psu_enabled": true,
+        "resistors": {"AUXRESET": 1.2, "VCM": 0.6}
+    }
+
+James Hogge, STFC Application Engineering Group.
+"""
+
+import os
+import json
+import time
+import logging
+from functools import partial
+
+from i2c_device import I2CDevice
+
+
+class ProfileError(Exception):
+    """Simple exception class for errors loading or applying profiles."""
+
+    pass
+
+
+class ProfileManager(object):
+    """ProfileManager class.
+
+    This class implements loading and diff-based application of board configuration
+    profiles to a Backplane instance.
+    """
+
+    # File extension of profile files in the profile directory
+    PROFILE_EXTENSION = '.json'
+
+    # Tolerance within which a setting is considered to already match the profile
+    VALUE_TOLERANCE = 1e-6
+
+    def __init__(self, backplane, profile_dir):
+        """Initialise the ProfileManager.
+
+        :param backplane: Backplane instance to apply profiles to
+        :param profile_dir: directory containing the profile files
+        """
+        self.backplane = backplane
+        self.profile_dir = profile_dir
+
+        self.active = ""
+        self.last_apply = {}
+
+    def get_available(self):
+        """Get the names of the profiles available in the profile directory.
+
+        :returns: sorted list of profile names
+        """
+        if not os.path.isdir(self.profile_dir):
+            return []
+
+        return sorted(
+            os.path.splitext(f)[0] for f in os.listdir(self.profile_dir)
+            if f.endswith(self.PROFILE_EXTENSION)
+        )
+
+    def get_active(self):
+        """Get the name of the last profile applied.
+
+        :returns: profile name, empty if no profile has been applied
+        """
+        return self.active
+
+    def get_last_apply(self):
+        """Get the report of the last profile application.
+
+        :returns: dict of changed settings, bus transactions and wall time (seconds)
+        """
+        return self.last_apply
+
+    def load(self, name):
+        """Load a profile from the profile directory.
+
+        :param name: name of the profile to load
+        :returns: dict of profile settings
+        """
+        if name not in self.get_available():
+            raise ProfileError("No profile named '{}' in {}".format(name, self.profile_dir))
+
+        path = os.path.join(self.profile_dir, name + self.PROFILE_EXTENSION)
+        try:
+            with open(path) as profile_file:
+                profile = json.load(profile_file)
+        except (IOError, ValueError) as e:
+            raise ProfileError("Failed to load profile '{}': {}".format(name, e))
+
+        if not isinstance(profile, dict):
+            raise ProfileError("Profile '{}' must contain a JSON object".format(name))
+
+        return profile
+
+    def diff(self, profile):
+        """Determine the settings in a profile which differ from the backplane state.
+
+        :param profile: dict of profile settings
+        :returns: list of (setting name, setter, value) tuples to be written
+        """
+        changes = []
+
+        if 'clock' in profile:
+            freq = float(profile['clock'])
+            if abs(freq - self.backplane.get_clock_frequency()) > self.VALUE_TOLERANCE:
+                changes.append(('clock', self.backplane.set_clock_frequency, freq))
+
+        if 'psu_enabled' in profile:
+            enable = bool(profile['psu_enabled'])
+            if enable != bool(self.backplane.get_psu_enable()):
+                changes.append(('psu_enabled', self.backplane.set_psu_enable, enable))
+
+        resistor_names = [self.backplane.get_resistor_name(i)
+                          for i in range(len(self.backplane.resistors))]
+        for name, value in profile.get('resistors', {}).items():
+            if name not in resistor_names:
+                raise ProfileError("Unknown resistor '{}' in profile".format(name))
+
+            index = resistor_names.index(name)
+            value = float(value)
+            # Resistors are set to the nearest wiper code, so compare codes rather than values
+            try:
+                code = self.backplane.nearest_wiper_code(index, value)
+            except ValueError as e:
+                raise ProfileError(str(e))
+            if code != self.backplane.get_resistor_wiper(index):
+                changes.append(('resistors/' + name,
+                                partial(self.backplane.set_resistor_value, index), value))
+
+        return changes
+
+    def apply_profile(self, name):
+        """Apply a named profile to the backplane.
+
+        Only the settings differing from the current backplane state are written. The
+        number of bus transactions and the wall time spent are recorded in last_apply.
+
+        :param name: name of the profile to apply
+        """
+        profile = self.load(name)
+
+        start_time = time.time()
+        start_count = I2CDevice.transaction_count
+
+        changes = self.diff(profile)
+        for _, setter, value in changes:
+            setter(value)
+
+        self.active = name
+        self.last_apply = {
+            "profile": name,
+            "changed": [setting for setting, _, _ in changes],
+            "transactions": I2CDevice.transaction_count - start_count,
+            "time": time.time() - start_time,
+        }
+        logging.debug("Applied profile %s: %s", name, self.last_apply)
@@ -0,0 +1,358 @@
+"""ResistorRegulator - closed-loop regulation of a resistor to a measured target.
+
+This class sets a variable resistor so that a feedback ADC channel reads a target value,
+rather than trusting the open-loop mapping of value to wiper code. It runs a search over
+wiper codes using fresh ADC readings, in two phases:
+
+    - Bracketing: starting from the current wiper code (or the lookup table code for the
+      target, where the feedback channel monitors the resistor's own rail), the search steps
+      outward along the secant through the last two readings, each step at most double the
+      last, until the target lies between two readings. The rail is never stepped straight
+      to the ends of the wiper range.
+    - Refinement: each step measures the code estimated by the secant through the bracket
+      ends (regula falsi, with the Illinois modification so that curved responses converge
+      from both sides), moved one code inwards if it rounds onto a bracket end.
+
+The search stops when a reading is within tolerance of the target or the bracket has closed
+to adjacent codes, and the code with the smallest error is left set. If the target cannot
+be bracketed, or the reading does not change with the code, the original code is restored.
+The report distinguishes a reading within tolerance (converged) from a bracket closed to
+adjacent codes without reaching tolerance.
+
+Regulation requests are specified as dicts, e.g.:
+
+    {"resistor": "VRESET", "target": 1.2, "channel": "VRESET", "field": "voltage",
+     "tolerance": 0.005, "settle": 0.01}
+
+The feedback channel defaults to the channel monitoring the resistor's rail, and must be
+given for resistors without a monitored rail. The field defaults to voltage and a start
+code may be given. A settle of "auto" waits for the feedback channel to settle after each
+write. The tolerance defaults to the finest the feedback reading can resolve: half an ADC
+step, or half the lookup table step at the target where the channel monitors the resistor's
+own rail.
+
+At most max_writes wiper writes are made, including the final write of the chosen (or
+original) code.
+
+The search writes the volatile wiper registers only, unless "volatile" is false, and the
+final code is then committed to non-volatile memory once, unless "commit" is false. A code
+is only committed if the regulation converged.
+
+James Hogge, STFC Application Engineering Group.
+"""
+
+import time
+
+
+class RegulationError(Exception):
+    """Simple exception class for errors in resistor regulation."""
+
+    pass
+
+
+class ResistorRegulator(object):
+    """ResistorRegulator class.
+
+    This class implements closed-loop regulation of the backplane variable resistors.
+    """
+
+    # Range of the TPL0102 wiper codes
+    MIN_CODE = 0
+    MAX_CODE = 255
+
+    # Maximum number of wiper writes made by a regulation, and the fewest allowing the first
+    # two bracket readings and the final write
+    MAX_WRITES = 16
+    MIN_WRITES = 3
+
+    # Full-scale code of the AD7998 12-bit conversions
+    ADC_FULL_SCALE = 4095
+
+    # Distance in codes of the first step from the start code
+    INITIAL_STEP = 4
+
+    def __init__(self, backplane):
+        """Initialise the ResistorRegulator.
+
+        :param backplane: Backplane instance whose resistors are regulated
+        """
+        self.backplane = backplane
+
+        self.results = {}
+
+    def get_results(self):
+        """Get the report of the last regulation.
+
+        :returns: dict of the target and tolerance, achieved code, value and error, whether it
+                  converged or the bracket closed, the number of writes made and the codes
+                  and readings measured
+        """
+        return self.results
+
+    def get_start_code(self, resistor, channel, field, target, spec):
+        """Get the wiper code a regulation starts from.
+
+        :param resistor: resistor index
+        :param channel: feedback channel index
+        :param field: feedback field, current or voltage
+        :param target: target reading
+        :param spec: regulation dict
+        :returns: the start code given in the spec, the lookup table code for the target if
+                  the feedback channel monitors the resistor's rail in the same units, or
+                  else the current wiper code
+        """
+        backplane = self.backplane
+        if "start" in spec:
+            code = int(spec["start"])
+            if not self.MIN_CODE <= code <= self.MAX_CODE:
+                raise RegulationError("Start code must be in the range {}-{}".format(
+                    self.MIN_CODE, self.MAX_CODE))
+            return code
+
+        if self.monitors_rail(resistor, channel, field):
+            try:
+                return backplane.nearest_wiper_code(resistor, target)
+            except ValueError:
+                pass
+
+        return backplane.get_resistor_wiper(resistor)
+
+    def monitors_rail(self, resistor, channel, field):
+        """Determine if a feedback reading is of the rail set by a resistor.
+
+        :param resistor: resistor index
+        :param channel: feedback channel index
+        :param field: feedback field, current or voltage
+        :returns: True if the channel monitors the resistor's rail in the units of its value
+        """
+        return (field == "voltage" and self.backplane.get_resistor_units(resistor) == "V" and
+                channel in self.backplane.RESISTOR_CHANNELS.get(resistor, []))
+
+    def get_default_tolerance(self, resistor, channel, field, target):
+        """Get the tolerance of a regulation which does not specify one.
+
+        :param resistor: resistor index
+        :param channel: feedback channel index
+        :param field: feedback field, current or voltage
+        :param target: target reading
+        :returns: half the ADC step of the feedback reading, or half the lookup table step at
+                  the target if that is larger and the feedback channel monitors the
+                  resistor's rail
+        """
+        backplane = self.backplane
+        multipliers = (backplane.VOLTAGE_MULTIPLIERS if field == "voltage" else
+                       backplane.CURRENT_MULTIPLIERS)
+        tolerance = multipliers[channel] / self.ADC_FULL_SCALE / 2
+
+        if self.monitors_rail(resistor, channel, field):
+            try:
+                code = backplane.nearest_wiper_code(resistor, target)
+            except ValueError:
+                return tolerance
+            lut = backplane.resistor_luts[resistor]
+            code = min(code, len(lut) - 2)
+            tolerance = max(tolerance, abs(lut[code + 1] - lut[code]) / 2)
+
+        return tolerance
+
+    def regulate(self, spec):
+        """Regulate a resistor to a target reading of its feedback channel.
+
+        :param spec: regulation dict
+        """
+        if not isinstance(spec, dict) or "resistor" not in spec or "target" not in spec:
+            raise RegulationError("Regulation requires a resistor and a target")
+
+        backplane = self.backplane
+        try:
+            resistor = backplane.get_resistor_index(spec["resistor"])
+            if "channel" in spec:
+                channel = backplane.get_adc_channel(spec["channel"])
+            elif resistor in backplane.RESISTOR_CHANNELS:
+                channel = backplane.RESISTOR_CHANNELS[resistor][0]
+            else:
+                raise RegulationError("Regulation of {} requires a feedback channel".format(
+                    backplane.get_resistor_name(resistor)))
+        except ValueError as e:
+            raise RegulationError(str(e))
+
+        field = spec.get("field", "voltage")
+        if field not in ("current", "voltage"):
+            raise RegulationError("Regulation field must be current or voltage")
+
+        target = float(spec["target"])
+        if "tolerance" in spec:
+            tolerance = float(spec["tolerance"])
+        else:
+            tolerance = self.get_default_tolerance(resistor, channel, field, target)
+        settle = spec.get("settle", 0.0)
+        max_writes = min(int(spec.get("max_writes", self.MAX_WRITES)), self.MAX_WRITES)
+        if max_writes < self.MIN_WRITES:
+            raise RegulationError("Regulation requires at least {} writes".format(
+                self.MIN_WRITES))
+        volatile = bool(spec.get("volatile", True))
+        commit = bool(spec.get("commit", True))
+        start_code = self.get_start_code(resistor, channel, field, target, spec)
+
+        readings = backplane.raw_voltages if field == "voltage" else backplane.raw_currents
+        history = []
+
+        def measure(code):
+            # Write the code and take a fresh reading of the feedback channel
+            backplane.set_resistor_wiper(resistor, code, save=False)
+            if settle == "auto":
+                backplane.settling.wait(backplane.get_resistor_name(resistor), [channel])
+            elif float(settle) > 0:
+                time.sleep(float(settle))
+            backplane.poll_channels([channel])
+            history.append((code, readings[channel]))
+            return readings[channel] - target
+
+        original_code = backplane.get_resistor_wiper(resistor)
+        original_mode = backplane.get_volatile_mode()
+        start_time = time.time()
+        committed = False
+        try:
+            if volatile and not original_mode:
+                backplane.set_volatile_mode(True)
+
+            # One write is reserved for setting the chosen code once the search is done
+            search_writes = max_writes - 1
+            lo, hi, err_lo, err_hi = self.bracket(measure, start_code, tolerance,
+                                                  search_writes, history)
+            bracketed = err_lo * err_hi <= 0
+            if bracketed:
+                lo, hi = self.refine(measure, lo, hi, err_lo, err_hi, tolerance, search_writes,
+                                     history)
+
+            code, value = min(history, key=lambda entry: abs(entry[1] - target))
+            converged = abs(value - target) <= tolerance
+
+            # Leave the code with the smallest error set if the target was bracketed,
+            # otherwise return to the original code, storing it in non-volatile memory
+            # only if the regulation converged
+            if not (bracketed or converged):
+                code = original_code
+            final_write = backplane.get_resistor_wiper(resistor) != code
+            if final_write:
+                backplane.set_resistor_wiper(resistor, code, save=False)
+            if commit and converged:
+                backplane.commit_resistor(resistor)
+                committed = True
+        finally:
+            if backplane.get_volatile_mode() != original_mode:
+                backplane.set_volatile_mode(original_mode)
+            backplane.save_state()
+
+        # The original code may not have been measured if the search did not start from it
+        value = dict(history).get(code)
+        self.results = {
+            "resistor": backplane.get_resistor_name(resistor),
+            "channel": backplane.get_adc_name(channel),
+            "field": field,
+            "target": target,
+            "tolerance": tolerance,
+            "start": start_code,
+            "code": code,
+            "value": value,
+            "error": value - target if value is not None else None,
+            "converged": converged,
+            "bracket_closed": bracketed and hi - lo <= 1,
+            "bracketed": bracketed,
+            "committed": committed,
+            "writes": len(history) + (1 if final_write else 0),
+            "history": [{"code": c, "value": v} for c, v in history],
+            "time": time.time() - start_time,
+        }
+
+    def bracket(self, measure, start_code, tolerance, max_writes, history):
+        """Step outward from the start code until the target is bracketed.
+
+        Each step is made along the secant through the best reading and the last reading,
+        limited to twice the distance between them, so that the rail moves progressively
+        rather than jumping to the ends of the range.
+
+        :param measure: function writing a code and returning the error of its reading
+        :param start_code: code to start from
+        :param tolerance: error within which a reading meets the target
+        :param max_writes: maximum number of writes
+        :param history: list of (code, reading) measured, appended to by measure
+        :returns: tuple of the lower and upper codes and their errors, the errors of
+                  opposite sign if the target was bracketed
+        """
+        prev_code, prev_err = start_code, measure(start_code)
+        if abs(prev_err) <= tolerance:
+            return prev_code, prev_code, prev_err, prev_err
+
+        step = self.INITIAL_STEP if start_code < self.MAX_CODE else -self.INITIAL_STEP
+        code = max(self.MIN_CODE, min(self.MAX_CODE, start_code + step))
+        err = measure(code)
+
+        while prev_err * err > 0 and abs(err) > tolerance and len(history) < max_writes:
+            # A reading which does not change with the code gives no direction to step in,
+            # e.g. if the feedback channel does not monitor the resistor's rail
+            if err == prev_err:
+                break
+
+            # Step from the better of the last two readings, towards the target along their
+            # secant
+            if abs(err) > abs(prev_err):
+                code, err, prev_code, prev_err = prev_code, prev_err, code, err
+            span = abs(code - prev_code)
+            estimate = code - err * (code - prev_code) / float(err - prev_err)
+            estimate = max(code - 2 * span, min(code + 2 * span, estimate))
+            next_code = max(self.MIN_CODE, min(self.MAX_CODE, int(round(estimate))))
+            if next_code in (code, prev_code):
+                next_code = code + (1 if estimate > code else -1)
+            if next_code == code or not self.MIN_CODE <= next_code <= self.MAX_CODE:
+                # The range is exhausted in the direction of the target
+                break
+
+            prev_code, prev_err = code, err
+            code, err = next_code, measure(next_code)
+
+        if code < prev_code:
+            return code, prev_code, err, prev_err
+        return prev_code, code, prev_err, err
+
+    def refine(self, measure, lo, hi, err_lo, err_hi, tolerance, max_writes, history):
+        """Narrow a bracket around the target by regula falsi with the Illinois method.
+
+        :param measure: function writing a code and returning the error of its reading
+        :param lo: lower code of the bracket
+        :param hi: upper code of the bracket
+        :param err_lo: error of the reading at the lower code
+        :param err_hi: error of the reading at the upper code, of opposite sign to err_lo
+        :param tolerance: error within which a reading meets the target
+        :param max_writes: maximum number of writes
+        :param history: list of (code, reading) measured, appended to by measure
+        :returns: tuple of the lower and upper codes of the final bracket
+        """
+        # Secant weights of the bracket ends, the errors scaled down when an end is retained
+        weight_lo, weight_hi = err_lo, err_hi
+        last_side = None
+        while hi - lo > 1 and len(history) < max_writes:
+            if min(abs(err_lo), abs(err_hi)) <= tolerance:
+                break
+
+            # Secant estimate, moved one code inwards if it rounds onto a bracket end
+            code = int(round(lo - weight_lo * (hi - lo) / (weight_hi - weight_lo)))
+            code = max(lo + 1, min(hi - 1, code))
+
+            err = measure(code)
+            if abs(err) <= tolerance:
+                break
+            side = "hi" if err * err_lo < 0 else "lo"
+            if side == "hi":
+                hi, err_hi, weight_hi = code, err, err
+                # Halve the weight of an end retained twice in a row (the Illinois method),
+                # so that curved responses do not converge from one side only
+                if side == last_side:
+                    weight_lo /= 2
+            else:
+                lo, err_lo, weight_lo = code, err, err
+                if side == last_side:
+                    weight_hi /= 2
+            last_side = side
+
+        return lo, hi
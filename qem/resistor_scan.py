@@ -0,0 +1,183 @@
+"""ResistorScan - variable resistor scans with synchronised sensor capture.
+
+This class steps one or two of the backplane variable resistors through lists of wiper
+codes, waiting a settle time at each point and then sampling a set of current/voltage
+channels. The readings are recorded into an array of shape
+
+    (codes of axis 0, [codes of axis 1,] channels, 2)
+
+holding the current and voltage of each channel at each point, averaged over the
+requested number of samples.
+
+Scans are specified as dicts, with axes given by resistor name or index and a list or
+range of wiper codes, e.g.:
+
+    {"axes": [{"resistor": "VCM", "start": 0, "stop": 255, "step": 5},
+              {"resistor": "VRESET", "codes": [0, 64, 128, 192, 255]}],
+     "settle": 0.05, "samples": 4, "channels": ["VDDO", "VDD_RST"]}
+
+With a settle of "auto" the settling time of each point is listed in the scan results.
+The array is held as a NumPy array where NumPy is installed, otherwise as a flat array of
+doubles, and its axes are described by the scan results. The resistors are restored to
+their original wiper codes afterwards unless "restore" is false.
+
+Wipers are written to the volatile registers only during a scan, unless "volatile" is
+false, so that each point costs only the register write rather than a non-volatile write.
+The non-volatile positions are left unchanged; an unrestored scan leaves its final codes
+in the volatile registers until they are committed.
+
+James Hogge, STFC Application Engineering Group.
+"""
+
+from array import array
+
+from sensor_capture import SensorCapture
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class ScanError(Exception):
+    """Simple exception class for errors in resistor scans."""
+
+    pass
+
+
+class ResistorScan(SensorCapture):
+    """ResistorScan class.
+
+    This class implements scans of the backplane variable resistors.
+    """
+
+    name = "scan"
+    error = ScanError
+
+    # Maximum number of axes and points in a scan
+    MAX_AXES = 2
+    MAX_POINTS = 65536
+
+    # Range of the TPL0102 wiper codes
+    MAX_CODE = 255
+
+    # Fields recorded for each channel
+    FIELDS = ["current", "voltage"]
+
+    def get_axis(self, axis):
+        """Get the resistor and wiper codes of a scan axis.
+
+        :param axis: axis dict
+        :returns: tuple of resistor index and list of wiper codes
+        """
+        if not isinstance(axis, dict) or "resistor" not in axis:
+            raise ScanError("Each scan axis must be a dict with a resistor")
+
+        try:
+            resistor = self.backplane.get_resistor_index(axis["resistor"])
+        except ValueError as e:
+            raise ScanError(str(e))
+
+        if "codes" in axis:
+            codes = [int(code) for code in axis["codes"]]
+        else:
+            start = int(axis.get("start", 0))
+            stop = int(axis.get("stop", self.MAX_CODE))
+            step = int(axis.get("step", 1))
+            if step == 0:
+                raise ScanError("Scan step must be non-zero")
+            codes = list(range(start, stop + (1 if step > 0 else -1), step))
+
+        if not codes or any(code < 0 or code > self.MAX_CODE for code in codes):
+            raise ScanError("Scan codes for {} must be in the range 0-{}".format(
+                self.backplane.get_resistor_name(resistor), self.MAX_CODE))
+
+        return resistor, codes
+
+    def run(self, spec):
+        """Run a resistor scan.
+
+        :param spec: scan dict
+        """
+        if not isinstance(spec, dict):
+            raise ScanError("A scan must be a dict")
+
+        axes = spec.get("axes")
+        if not isinstance(axes, list) or not 1 <= len(axes) <= self.MAX_AXES:
+            raise ScanError("A scan requires 1 to {} axes".format(self.MAX_AXES))
+        axes = [self.get_axis(axis) for axis in axes]
+        if len(set(resistor for resistor, _ in axes)) != len(axes):
+            raise ScanError("Scan axes must use different resistors")
+
+        backplane = self.backplane
+        try:
+            channels = [backplane.get_adc_channel(channel)
+                        for channel in spec.get("channels", backplane.ADC_CHANNELS)]
+        except ValueError as e:
+            raise ScanError(str(e))
+        if not channels:
+            raise ScanError("A scan requires at least one channel")
+
+        settle = self.get_settle(spec)
+        samples = max(int(spec.get("samples", 1)), 1)
+        restore = bool(spec.get("restore", True))
+        volatile = bool(spec.get("volatile", True))
+
+        shape = [len(codes) for _, codes in axes] + [len(channels), len(self.FIELDS)]
+        points = 1
+        for dimension in shape[:-2]:
+            points *= dimension
+        if points > self.MAX_POINTS:
+            raise ScanError("Scan exceeds {} points".format(self.MAX_POINTS))
+
+        # Readings are written into a preallocated flat buffer as the scan runs
+        size = points * len(channels) * len(self.FIELDS)
+        data = numpy.zeros(size) if numpy is not None else array('d', [0.0]) * size
+
+        self.results = {
+            "axes": [{"resistor": backplane.get_resistor_name(resistor), "codes": codes}
+                     for resistor, codes in axes],
+            "channels": [backplane.get_adc_name(i) for i in channels],
+            "fields": self.FIELDS,
+            "shape": shape,
+            "points": 0,
+            "settling": [],
+        }
+
+        original_codes = [(resistor, backplane.get_resistor_wiper(resistor))
+                          for resistor, _ in axes]
+        original_mode = backplane.get_volatile_mode()
+
+        def restore_hardware():
+            if restore:
+                for resistor, code in original_codes:
+                    backplane.set_resistor_wiper(resistor, code, save=False)
+            if backplane.get_volatile_mode() != original_mode:
+                backplane.set_volatile_mode(original_mode)
+            backplane.save_state()
+
+        offset = 0
+        with self.capture(data.reshape(shape) if numpy is not None else data, restore_hardware):
+            if volatile and not original_mode:
+                backplane.set_volatile_mode(True)
+
+            for point in range(points):
+                # Set the codes of each axis, the last axis changing fastest
+                index = point
+                for resistor, codes in reversed(axes):
+                    index, code_index = divmod(index, len(codes))
+                    if point == 0 or backplane.get_resistor_wiper(resistor) != codes[code_index]:
+                        backplane.set_resistor_wiper(resistor, codes[code_index], save=False)
+
+                settling = self.settle(settle, "scan", channels)
+                if settle == "auto":
+                    self.results["settling"].append(settling)
+
+                for _ in range(samples):
+                    backplane.poll_channels(channels)
+                    for n, i in enumerate(channels):
+                        data[offset + 2 * n] += backplane.raw_currents[i] / samples
+                        data[offset + 2 * n + 1] += backplane.raw_voltages[i] / samples
+
+                offset += 2 * len(channels)
+                self.results["points"] = point + 1
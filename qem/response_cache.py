@@ -0,0 +1,94 @@
+"""ResponseCache - per-snapshot cache of serialised and compressed GET responses.
+
+This class caches the JSON serialisation of parameter tree responses, together with
+gzip and zlib (deflate) compressed copies, for each snapshot of the backplane state. A
+snapshot is identified by the number of published poll cycles, parameter writes and
+completed hardware worker jobs, the revisions of the poll scheduler rates and settling
+results, and the profiles available on disk, so that serialisation and compression of large
+responses (e.g. the tree with metadata) run once per snapshot rather than once per client.
+
+James Hogge, STFC Application Engineering Group.
+"""
+
+import io
+import gzip
+import json
+import zlib
+
+
+def gzip_compress(data):
+    """Compress data in gzip format.
+
+    :param data: bytes to compress
+    :returns: gzip compressed bytes
+    """
+    buff = io.BytesIO()
+    gzip_file = gzip.GzipFile(fileobj=buff, mode='wb', mtime=0)
+    gzip_file.write(data)
+    gzip_file.close()
+    return buff.getvalue()
+
+
+class ResponseCache(object):
+    """ResponseCache class.
+
+    This class implements a cache of serialised responses keyed by path and metadata flag,
+    invalidated when the backplane snapshot changes.
+    """
+
+    # Compressed response types mapped to their compression functions
+    ENCODINGS = {
+        'application/gzip': gzip_compress,
+        'application/zlib': zlib.compress,
+    }
+
+    # Maximum number of paths cached
+    MAX_ENTRIES = 32
+
+    def __init__(self, backplane_data):
+        """Initialise the ResponseCache.
+
+        :param backplane_data: BackplaneData instance responses are generated from
+        """
+        self.backplane_data = backplane_data
+        self.entries = {}
+
+    def get_version(self):
+        """Get the version identifying the current snapshot of the backplane state.
+
+        :returns: tuple of the poll cycle, parameter write and completed job counts, the
+                  scheduler and settling revisions and the available profile names
+        """
+        backplane_data = self.backplane_data
+        # Profile files may be added or removed outside the adapter, so the directory
+        # listing is part of the snapshot
+        return (backplane_data.backplane.update_count, backplane_data.write_count,
+                backplane_data.job_count, backplane_data.scheduler.revision,
+                backplane_data.backplane.settling.revision,
+                tuple(backplane_data.profiles.get_available()))
+
+    def get(self, path, metadata, content_type='application/json'):
+        """Get the serialised response for a path.
+
+        :param path: path in the parameter tree
+        :param metadata: include metadata in the response
+        :param content_type: application/json or one of the compressed ENCODINGS
+        :returns: serialised (and compressed) response
+        """
+        key = (path.strip('/'), metadata)
+        version = self.get_version()
+
+        entry = self.entries.get(key)
+        if entry is None or entry['version'] != version:
+            if entry is None and len(self.entries) >= self.MAX_ENTRIES:
+                self.entries.clear()
+            entry = {
+                'version': version,
+                'application/json': json.dumps(self.backplane_data.get(path, metadata)),
+            }
+            self.entries[key] = entry
+
+        if content_type not in entry:
+            entry[content_type] = self.ENCODINGS[content_type](entry['application/json'])
+
+        return entry[content_type]
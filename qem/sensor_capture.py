@@ -0,0 +1,122 @@
+"""SensorCapture - base class for runs capturing sensor readings at a series of points.
+
+Resistor scans and frequency sweeps step a backplane setpoint through a series of points,
+waiting at each point for the captured channels to settle before recording their readings.
+This class holds what they share:
+
+    - the settle option, either a fixed time in seconds or "auto" to wait at each point
+      until the captured channels have settled;
+    - the capture of points into a preallocated or growing buffer, keeping the points
+      captured and restoring the hardware even if a later point fails;
+    - the export of the captured data as little-endian float64 values in C order.
+
+The data are not held in the parameter tree, so that the tree stays small, and are
+downloaded in binary form after the run.
+
+James Hogge, STFC Application Engineering Group.
+"""
+
+import sys
+import time
+from array import array
+from contextlib import contextmanager
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class SensorCapture(object):
+    """SensorCapture class.
+
+    This class implements the settling, capture and export shared by scans and sweeps.
+    Subclasses set the name of the run and the exception class raised for its errors.
+    """
+
+    name = "capture"
+    error = Exception
+
+    def __init__(self, backplane):
+        """Initialise the SensorCapture.
+
+        :param backplane: Backplane instance to capture the readings of
+        """
+        self.backplane = backplane
+
+        self.results = {}
+        self.data = None
+        self.time = 0.0
+
+    def get_results(self):
+        """Get the description of the last run.
+
+        :returns: dict of the shape of the data and the number of points captured
+        """
+        return self.results
+
+    def get_time(self):
+        """Get the time taken by the last run.
+
+        :returns: wall time (seconds)
+        """
+        return self.time
+
+    def get_data(self):
+        """Get the data of the last run in binary form.
+
+        :returns: little-endian float64 bytes in C order, of the shape given in the results
+        """
+        if self.data is None:
+            raise self.error("No {} data available".format(self.name))
+
+        if numpy is not None and isinstance(self.data, numpy.ndarray):
+            return self.data.astype('<f8').tobytes()
+
+        data = array('d', self.data)
+        if sys.byteorder != 'little':
+            data.byteswap()
+        return data.tostring()
+
+    def get_settle(self, spec):
+        """Get the settle option of a run.
+
+        :param spec: run dict
+        :returns: "auto", or the fixed settle time (seconds)
+        """
+        settle = spec.get("settle", 0.0)
+        return settle if settle == "auto" else float(settle)
+
+    def settle(self, settle, source, channels):
+        """Wait for the captured channels to settle at a point.
+
+        :param settle: settle option returned by get_settle
+        :param source: name of the setpoint changed, passed to the settling detector
+        :param channels: channel indices captured
+        :returns: settling time measured (seconds), zero for a fixed settle time
+        """
+        if settle == "auto":
+            return self.backplane.settling.wait(source, channels)
+        if settle > 0:
+            time.sleep(settle)
+        return 0.0
+
+    @contextmanager
+    def capture(self, data, restore):
+        """Capture the points of a run.
+
+        The results must be set, with a count of the points captured, before the capture
+        starts. The points captured are kept as the data of the run, and the hardware is
+        restored, even if a later point fails.
+
+        :param data: buffer the points are captured into
+        :param restore: function restoring the hardware after the run
+        :returns: context yielding the start time of the run
+        """
+        start_time = time.time()
+        try:
+            yield start_time
+        finally:
+            self.data = data if self.results["points"] else None
+            restore()
+            self.time = time.time() - start_time
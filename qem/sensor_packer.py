@@ -0,0 +1,90 @@
+"""SensorPacker - compact binary representation of the backplane sensor readings.
+
+This class packs the per-cycle sensor readings of the backplane (13 currents, 13 voltages
+and 8 power good inputs) into a fixed-layout little-endian struct, for high-rate machine
+clients which would otherwise parse the full JSON parameter tree on every read. The packed
+record is built once per poll cycle into a preallocated buffer and the layout is described
+by a schema, allowing clients to unpack it with e.g. struct or numpy.
+
+James Hogge, STFC Application Engineering Group.
+"""
+
+import struct
+
+
+class SensorPacker(object):
+    """SensorPacker class.
+
+    This class implements packing of the backplane sensor readings into a fixed-layout
+    binary record.
+    """
+
+    # Record fields as (name, struct type, count, units)
+    FIELDS = [
+        ("update_count", "I", 1, ""),
+        ("update_time", "d", 1, "s"),
+        ("current", "f", 13, "mA"),
+        ("voltage", "f", 13, "V"),
+        ("power_good", "?", 8, ""),
+    ]
+
+    def __init__(self, backplane):
+        """Initialise the SensorPacker.
+
+        :param backplane: Backplane instance to pack readings from
+        """
+        self.backplane = backplane
+
+        self.struct = struct.Struct(
+            '<' + ''.join('{}{}'.format(count, fmt) for _, fmt, count, _ in self.FIELDS))
+        self.buffer = bytearray(self.struct.size)
+        self.packed_version = None
+        self.packed = None
+
+    def get_packed(self):
+        """Get the binary record of the current sensor readings.
+
+        The record is only repacked when the backplane has completed a new poll cycle. A
+        cycle in which no reading passed its deadband still updates the time of the record,
+        so that clients can tell how fresh the readings are.
+
+        :returns: packed record
+        """
+        backplane = self.backplane
+        version = (backplane.update_count, backplane.update_time)
+        if version != self.packed_version:
+            self.packed_version = version
+            values = [backplane.update_count & 0xFFFFFFFF, backplane.update_time]
+            values.extend(backplane.currents)
+            values.extend(backplane.voltages)
+            values.extend(backplane.power_good)
+            self.struct.pack_into(self.buffer, 0, *values)
+            self.packed = bytes(self.buffer)
+
+        return self.packed
+
+    def get_schema(self):
+        """Get the schema describing the layout of the binary record.
+
+        :returns: dict describing the struct format, size and the offset of each field
+        """
+        fields = []
+        offset = 0
+        for name, fmt, count, units in self.FIELDS:
+            fields.append({
+                "name": name,
+                "type": fmt,
+                "count": count,
+                "offset": offset,
+                "units": units,
+            })
+            offset += struct.calcsize('<{}{}'.format(count, fmt))
+
+        return {
+            "format": self.struct.format,
+            "size": self.struct.size,
+            "byte_order": "little",
+            "fields": fields,
+            "current_names": [self.backplane.get_adc_name(i)
+                              for i in range(len(self.backplane.currents))],
+        }
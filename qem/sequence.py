@@ -0,0 +1,190 @@
+"""SequenceRunner - server-side command sequences for the QEM backplane.
+
+This class allows a list of set/get/wait/wait_until steps to be run server-side in a
+single request, returning all readbacks in one response rather than requiring a client
+to make many HTTP round trips with sleeps in between. Waits are timed against the
+sensor poll interval, polling the backplane sensors so that readbacks following a wait
+reflect fresh readings.
+
+Steps are specified as dicts, e.g.:
+
+    [
+        {"set": "psu_enabled", "value": true},
+        {"wait": 0.5},
+        {"wait_until": "current_voltage/7/voltage", "condition": ">", "value": 3.0,
+         "timeout": 5.0},
+        {"get": "current_voltage"}
+    ]
+
+James Hogge, STFC Application Engineering Group.
+"""
+
+import time
+import operator
+
+
+class SequenceError(Exception):
+    """Simple exception class for errors in command sequences."""
+
+    pass
+
+
+class SequenceRunner(object):
+    """SequenceRunner class.
+
+    This class implements execution of command sequences against a BackplaneData instance.
+    """
+
+    # Comparison operators allowed in wait_until steps
+    CONDITIONS = {
+        "==": operator.eq,
+        "!=": operator.ne,
+        "<": operator.lt,
+        "<=": operator.le,
+        ">": operator.gt,
+        ">=": operator.ge,
+    }
+
+    # Default timeout for wait_until steps (seconds)
+    DEFAULT_TIMEOUT = 10.0
+
+    def __init__(self, backplane_data, poll_interval):
+        """Initialise the SequenceRunner.
+
+        :param backplane_data: BackplaneData instance the sequence steps access
+        :param poll_interval: interval at which sensors are polled during waits (seconds)
+        """
+        self.backplane_data = backplane_data
+        self.poll_interval = poll_interval
+
+        self.results = []
+        self.time = 0.0
+
+    def get_results(self):
+        """Get the readbacks from the last sequence run.
+
+        :returns: list of readback dicts, one per get or wait_until step
+        """
+        return self.results
+
+    def get_time(self):
+        """Get the time taken to run the last sequence.
+
+        :returns: wall time (seconds)
+        """
+        return self.time
+
+    def run(self, steps):
+        """Run a command sequence.
+
+        :param steps: list of step dicts to execute in order
+        """
+        if not isinstance(steps, list):
+            raise SequenceError("A sequence must be a list of steps")
+
+        results = []
+        start_time = time.time()
+
+        # Keep the readbacks of completed steps even if a later step fails
+        try:
+            for index, step in enumerate(steps):
+                self._run_step(index, step, results)
+        finally:
+            self.results = results
+            self.time = time.time() - start_time
+
+    def _run_step(self, index, step, results):
+        """Run a single step of a sequence.
+
+        :param index: index of the step in the sequence
+        :param step: step dict
+        :param results: list of readbacks to append to
+        """
+        if not isinstance(step, dict):
+            raise SequenceError("Step {} must be a dict".format(index))
+
+        if "set" in step:
+            self._check_path(step["set"])
+            if "value" not in step:
+                raise SequenceError("Step {} has no value to set".format(index))
+            self.backplane_data.set(step["set"], step["value"])
+
+        elif "get" in step:
+            self._check_path(step["get"])
+            results.append({
+                "step": index,
+                "path": step["get"],
+                "value": self.backplane_data.get(step["get"], False),
+            })
+
+        elif "wait" in step:
+            self._wait(float(step["wait"]))
+
+        elif "wait_until" in step:
+            results.append(self._wait_until(index, step))
+
+        else:
+            raise SequenceError("Step {} has no recognised action".format(index))
+
+    def _check_path(self, path):
+        """Check a path is allowed to be accessed within a sequence.
+
+        :param path: parameter tree path accessed by a step
+        """
+        if path.strip('/').split('/')[0] == "sequence":
+            raise SequenceError("Sequences cannot access the sequence path")
+
+    def _read_leaf(self, path):
+        """Read the value of a single parameter.
+
+        :param path: parameter tree path of the parameter
+        :returns: parameter value
+        """
+        self._check_path(path)
+        return self.backplane_data.get(path, False)[path.rstrip('/').split('/')[-1]]
+
+    def _wait(self, duration):
+        """Wait for a duration, polling sensors at the poll interval.
+
+        :param duration: time to wait (seconds)
+        """
+        end_time = time.time() + duration
+        while True:
+            remaining = end_time - time.time()
+            if remaining <= 0:
+                break
+            time.sleep(min(self.poll_interval, remaining))
+            self.backplane_data.backplane.poll_all_sensors()
+
+    def _wait_until(self, index, step):
+        """Wait until a parameter satisfies a condition, polling at the poll interval.
+
+        :param index: index of the step in the sequence
+        :param step: wait_until step dict
+        :returns: readback dict containing the final value and time waited
+        """
+        condition = step.get("condition", "==")
+        if condition not in self.CONDITIONS:
+            raise SequenceError("Step {} has unknown condition {}".format(index, condition))
+        if "value" not in step:
+            raise SequenceError("Step {} has no value to compare against".format(index))
+
+        compare = self.CONDITIONS[condition]
+        timeout = float(step.get("timeout", self.DEFAULT_TIMEOUT))
+        start_time = time.time()
+
+        value = self._read_leaf(step["wait_until"])
+        while not compare(value, step["value"]):
+            if time.time() - start_time >= timeout:
+                raise SequenceError("Step {} timed out waiting for {} {} {}".format(
+                    index, step["wait_until"], condition, step["value"]))
+            time.sleep(self.poll_interval)
+            self.backplane_data.backplane.poll_all_sensors()
+            value = self._read_leaf(step["wait_until"])
+
+        return {
+            "step": index,
+            "path": step["wait_until"],
+            "value": value,
+            "waited": time.time() - start_time,
+        }
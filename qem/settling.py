@@ -0,0 +1,133 @@
+"""SettlingDetector - detection of rail settling after backplane setpoint changes.
+
+This class polls the ADC channels affected by a setpoint change (e.g. a resistor value or
+the clock frequency) at the maximum rate, and detects when they have settled: when the
+current and voltage readings of every channel have stayed within a tolerance band, a
+fraction of each channel's full-scale range, over a window of consecutive samples. The
+measured settling time, from the change to the first sample of the settled window, is
+reported, so that callers can wait exactly as long as needed rather than sleeping a fixed,
+conservative time.
+
+James Hogge, STFC Application Engineering Group.
+"""
+
+import time
+
+
+class SettlingDetector(object):
+    """SettlingDetector class.
+
+    This class implements settling detection of backplane current/voltage channels.
+    """
+
+    def __init__(self, backplane, enabled=False, tolerance=0.002, window=4, timeout=1.0):
+        """Initialise the SettlingDetector.
+
+        :param backplane: Backplane instance to poll
+        :param enabled: wait for settling after setpoint changes made through the backplane
+        :param tolerance: band readings must stay within, as a fraction of full scale
+        :param window: number of consecutive samples which must lie within the band
+        :param timeout: maximum time to wait for settling (seconds)
+        """
+        self.backplane = backplane
+        self.enabled = enabled
+        self.tolerance = tolerance
+        self.window = window
+        self.timeout = timeout
+
+        self.last = {}
+        # Incremented with each settling result, identifying the state of last
+        self.revision = 0
+
+    def get_enabled(self):
+        """Get whether setpoint changes wait for settling."""
+        return self.enabled
+
+    def set_enabled(self, enabled):
+        """Set whether setpoint changes wait for settling."""
+        self.enabled = bool(enabled)
+
+    def get_tolerance(self):
+        """Get the settling band as a fraction of full scale."""
+        return self.tolerance
+
+    def set_tolerance(self, tolerance):
+        """Set the settling band as a fraction of full scale."""
+        self.tolerance = float(tolerance)
+
+    def get_timeout(self):
+        """Get the maximum time to wait for settling (seconds)."""
+        return self.timeout
+
+    def set_timeout(self, timeout):
+        """Set the maximum time to wait for settling (seconds)."""
+        self.timeout = float(timeout)
+
+    def get_last(self):
+        """Get the result of the last settling wait.
+
+        :returns: dict of the source of the change, channels and number of polls, settling
+                  time and whether the channels settled within the timeout
+        """
+        return self.last
+
+    def wait(self, source, channels):
+        """Wait for channels to settle after a setpoint change.
+
+        :param source: description of the change, e.g. the parameter changed
+        :param channels: indices of the channels affected by the change
+        :returns: settling time (seconds), or the timeout if the channels did not settle
+        """
+        backplane = self.backplane
+        window = max(int(self.window), 2)
+        bands = [(self.tolerance * backplane.CURRENT_MULTIPLIERS[i],
+                  self.tolerance * backplane.VOLTAGE_MULTIPLIERS[i]) for i in channels]
+
+        # Rolling window of (time, currents, voltages) samples
+        samples = []
+        polls = 0
+        start = time.time()
+        settled = False
+        while True:
+            backplane.poll_channels(channels)
+            polls += 1
+            now = time.time()
+            samples.append((now, [backplane.raw_currents[i] for i in channels],
+                            [backplane.raw_voltages[i] for i in channels]))
+            if len(samples) > window:
+                samples.pop(0)
+
+            if len(samples) == window and self.within_bands(samples, bands):
+                settled = True
+                settling_time = samples[0][0] - start
+                break
+            if now - start >= self.timeout:
+                settling_time = now - start
+                break
+
+        self.last = {
+            "source": source,
+            "channels": [backplane.get_adc_name(i) for i in channels],
+            "time": settling_time,
+            "settled": settled,
+            "polls": polls,
+        }
+        self.revision += 1
+        return settling_time
+
+    @staticmethod
+    def within_bands(samples, bands):
+        """Check whether a window of samples lies within the tolerance band of each channel.
+
+        :param samples: list of (time, currents, voltages) samples
+        :param bands: list of (current band, voltage band) for each channel
+        :returns: True if the spread of every reading is within its band
+        """
+        for n, (current_band, voltage_band) in enumerate(bands):
+            currents = [sample[1][n] for sample in samples]
+            voltages = [sample[2][n] for sample in samples]
+            if max(currents) - min(currents) > current_band:
+                return False
+            if max(voltages) - min(voltages) > voltage_band:
+                return False
+        return True
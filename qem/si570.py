@@ -7,7 +7,8 @@ James Hogge, STFC Application Engineering Group.
 """
 
 from i2c_device import I2CDevice, I2CException
-import math, sys
+import math, sys, time
+from collections import OrderedDict
 
 class SI570(I2CDevice):
 	"""SI570 class.
@@ -20,9 +21,29 @@ class SI570(I2CDevice):
 	SI570_B = 0
 	SI570_C  = 1
 
-	def __init__(self, address=0x55, model=SI570_C, **kwargs):
+	#Valid range of the internal oscillator (Megahertz)
+	FDCO_MIN = 4850.0
+	FDCO_MAX = 5670.0
+
+	#Time allowed for RECALL to complete and interval between polls (seconds)
+	RECALL_TIMEOUT = 0.1
+	RECALL_POLL_INTERVAL = 0.001
+
+	#Number of frequency solutions retained in the solver cache
+	SOLUTION_CACHE_SIZE = 256
+
+	#Largest change from the last full reprogram which can be made by RFREQ alone (ppm)
+	SMALL_STEP_PPM = 3500
+
+	#Paths taken by set_frequency
+	FULL = "full"
+	SMALL_STEP = "small_step"
+
+	def __init__(self, address=0x55, model=SI570_C, state=None, **kwargs):
 		"""Initialise the SI570 and determine the crystal frequency.
-		This resets the device to the factory programmed frequency.
+		If a crystal frequency saved by get_state() is passed in state, the device is left
+		running at its current frequency. Otherwise the device is calibrated, resetting it to
+		the factory programmed frequency.
 		"""
 
 		I2CDevice.__init__(self, address, **kwargs)
@@ -30,15 +51,63 @@ class SI570(I2CDevice):
 		#Registers used are dependant on the device model
 		self.__register = 13 if model == self.SI570_C else 7
 
-		#Reset device to 156.25MHz and calculate fXTAL
+		#LRU cache of frequencies mapped to their dividers, RFREQ and register image
+		self.__solutions = OrderedDict()
+
+		#Shadow of the freeze/control register 137, read on first use
+		self.__reg137 = None
+
+		#Read the current register configuration
+		data = self.readList(self.__register, 6)
+		self.__hs_div, self.__n1, self.__rfreq = self.__calculate_params(data)
+
+		#Use the saved fXTAL if it gives a valid oscillator frequency for the current registers
+		self.__fxtal = state.get("fxtal") if state else None
+		if self.__fxtal is None or not self.FDCO_MIN <= self.__fxtal * self.__rfreq <= self.FDCO_MAX:
+			self.calibrate()
+
+		#Frequency of the last full reprogram, about which small steps are made
+		self.__centre_freq = self.get_frequency()
+		self.__last_path = None
+
+	def calibrate(self):
+		"""Reset the device to 156.25MHz and calculate fXTAL from the factory configuration.
+		"""
+
+		#Recall the factory configuration, waiting for the RECALL bit to clear
 		self.write8(135, 1 << 7)
+		deadline = time.time() + self.RECALL_TIMEOUT
 		while self.readU8(135) & 1:
-			continue;
+			if time.time() > deadline:
+				raise I2CException("Timed out waiting for SI570 RECALL to complete")
+			time.sleep(self.RECALL_POLL_INTERVAL)
 
 		#Device is reset, read initial register configurations
 		data = self.readList(self.__register, 6)
 		self.__hs_div, self.__n1, self.__rfreq = self.__calculate_params(data)
 		self.__fxtal = (156250000 * self.__hs_div * self.__n1) / self.__rfreq / 1000000
+		self.__solutions.clear()
+
+	def get_state(self):
+		"""Returns the calibration of the device for persisting.
+
+		:returns: dict of the crystal frequency (Megahertz)
+		"""
+		return {"fxtal": self.__fxtal}
+
+	def get_frequency(self):
+		"""Returns the output frequency the device is configured for.
+
+		:returns: Output frequency (Megahertz)
+		"""
+		return self.__fxtal * self.__rfreq / (self.__hs_div * self.__n1)
+
+	def get_last_path(self):
+		"""Returns the path taken by the last call to set_frequency.
+
+		:returns: SI570.FULL, SI570.SMALL_STEP or None if the frequency has not been set
+		"""
+		return self.__last_path
 
 	def get_fxtal(self):
 		"""Returns the crystal frequency of the device.
@@ -83,57 +152,139 @@ class SI570(I2CDevice):
 		return ret
 		
 
+	def __solve(self, freq):
+		"""Determines the dividers, RFREQ and register image for a frequency.
+		Solutions depend on fXTAL, so the cache is cleared by calibrate().
+
+		:param freq: Desired frequency [10 - 945] (Megahertz)
+		:returns: Tuple of HS_DIV, N1, RFREQ and the 6-byte register image
+		"""
+
+		solution = self.__solutions.pop(freq, None)
+		if solution is None:
+			if not 10.0 <= freq <= 945.0:
+				raise I2CException("The frequency %fMHz is out of the range of this device" % freq)
+
+			#Determine divider combination to be used
+			#Min/max dividers to use based on possible oscillator frequencies
+			divider_max = int(math.floor(self.FDCO_MAX / freq))
+			divider_min = int(math.ceil(self.FDCO_MIN / freq))
+			found = False
+
+			for divider in range(divider_min, divider_max + 1):
+				for hs_div in [11, 9, 7, 6, 5, 4]:
+					n1 = int(float(divider) / hs_div)
+
+					#If desired divider can be produced from HS_DIV and N1
+					if n1 == float(divider) / hs_div and (n1 == 1 or n1 & 1 == 0):
+						found = True
+						break
+				if found:
+					break
+			else:
+				raise I2CException("There is no possible divider combination for %f MHz" % freq)
+
+			#Calculate RFREQ from divider choice
+			rfreq = freq * hs_div * n1 / self.__fxtal
+
+			raw_hs_div = hs_div - 4
+			raw_n1 = n1 - 1
+			raw_rfreq = int(rfreq * 2**28)
+			image = tuple(map(int, [(raw_hs_div << 5) + (raw_n1 >> 2),
+				((raw_n1 & 0b11) << 6) + ((raw_rfreq >> 32) & 0b111111),
+				(raw_rfreq >> 24) & 0xff,
+				(raw_rfreq >> 16) & 0xff,
+				(raw_rfreq >> 8) & 0xff,
+				raw_rfreq & 0xff]))
+
+			solution = (hs_div, n1, rfreq, image)
+			if len(self.__solutions) >= self.SOLUTION_CACHE_SIZE:
+				self.__solutions.popitem(last=False)
+
+		#Reinsert as the most recently used solution
+		self.__solutions[freq] = solution
+		return solution
+
+	def precompute(self, freqs):
+		"""Solves and caches the register images for a list of frequencies, e.g. a planned scan.
+
+		:param freqs: List of frequencies [10 - 945] (Megahertz)
+		"""
+
+		for freq in freqs:
+			self.__solve(freq)
+
+	def __write_reg137(self, value):
+		"""Writes the freeze/control register 137, updating its shadow.
+
+		:param value: Register value
+		"""
+
+		self.write8(137, value)
+		self.__reg137 = value
+
 	def set_frequency(self, freq):
 		"""Sets the output frequency of the oscillator.
+		Frequencies within SMALL_STEP_PPM of the last full reprogram are set glitch-free by
+		writing RFREQ alone, otherwise the dividers are reprogrammed.
 		
 		:param freq: Desired frequency [10 - 945] (Megahertz)
+		:returns: Path taken, SI570.SMALL_STEP or SI570.FULL
 		"""
 
-		if not 10.0 <= freq <= 945.0:
-			raise I2CException("The frequency %fMHz is out of the range of this device")
-
-		#Determine divider combination to be used
-		#Min/max dividers to use based on possible oscillator frequencies		
-		divider_max = int(math.floor(5670.0 / freq))
-		divider_min = int(math.ceil(4850.0 / freq))
-		found = False
-
-
-		for divider in range(divider_min, divider_max + 1):
-			for hs_div in [11, 9, 7, 6, 5, 4]:
-				n1 = int(float(divider) / hs_div)
-				
-				#If desired divider can be produced from HS_DIV and N1
-				if n1 == float(divider) / hs_div and (n1 == 1 or n1 & 1 == 0):
-					found = True
-					self.__n1 = n1
-					self.__hs_div = hs_div
-					break;
-			if found:
-				break;
+		small_step = abs(freq - self.__centre_freq) <= self.__centre_freq * self.SMALL_STEP_PPM * 1e-6
+		if small_step and self.FDCO_MIN <= freq * self.__hs_div * self.__n1 <= self.FDCO_MAX:
+			self.__set_rfreq(freq)
+			self.__last_path = self.SMALL_STEP
 		else:
-			raise I2CException("There is no possible divider combination for %f MHz" % freq)
+			self.__set_dividers(freq)
+			self.__centre_freq = freq
+			self.__last_path = self.FULL
+
+		return self.__last_path
+
+	def __set_rfreq(self, freq):
+		"""Sets the output frequency by writing RFREQ alone under Freeze M.
+		The dividers are unchanged, so the output does not stop.
+
+		:param freq: Desired frequency, close to the current frequency (Megahertz)
+		"""
 
-		#Calculate RFREQ from divider choice
 		self.__rfreq = freq * self.__hs_div * self.__n1 / self.__fxtal
 
-		#Freeze the oscillator
-		self.write8(137, self.readU8(137) | 0x10)
-		
-		#Update device with new values
-		raw_hs_div = self.__hs_div - 4
+		#The first RFREQ register also holds the low bits of N1
 		raw_n1 = self.__n1 - 1
 		raw_rfreq = int(self.__rfreq * 2**28)
-		self.writeList(self.__register,
-			map(int,[(raw_hs_div << 5) + (raw_n1 >> 2),
-			((raw_n1 & 0b11) << 6) + ((raw_rfreq >> 32) & 0b111111),
+		image = map(int, [((raw_n1 & 0b11) << 6) + ((raw_rfreq >> 32) & 0b111111),
 			(raw_rfreq >> 24) & 0xff,
 			(raw_rfreq >> 16) & 0xff,
 			(raw_rfreq >> 8) & 0xff,
-			raw_rfreq & 0xff]))
+			raw_rfreq & 0xff])
+
+		#Freeze M so that the RFREQ registers are applied together, then release
+		self.write8(135, 0x20)
+		self.writeList(self.__register + 1, image)
+		self.write8(135, 0)
+
+	def __set_dividers(self, freq):
+		"""Sets the output frequency by reprogramming the dividers and RFREQ.
+
+		:param freq: Desired frequency [10 - 945] (Megahertz)
+		"""
+
+		self.__hs_div, self.__n1, self.__rfreq, image = self.__solve(freq)
+
+		if self.__reg137 is None:
+			self.__reg137 = self.readU8(137)
+
+		#Freeze the oscillator
+		self.__write_reg137(self.__reg137 | 0x10)
+
+		#Update device with new values
+		self.writeList(self.__register, list(image))
 
 		#Unfreeze the oscillator and set NEWFREQ flag
-		self.write8(137, self.readU8(137) & 0xEF)
+		self.__write_reg137(self.__reg137 & 0xEF)
 		self.write8(135, 0x40)
 
 
@@ -0,0 +1,89 @@
+"""Test cases for the poll allocation benchmark from qem.
+
+James Hogge, STFC Application Engineering Group.
+"""
+
+import sys
+
+if sys.version_info[0] == 3:  # pragma: no cover
+    from unittest.mock import Mock, patch
+else:                         # pragma: no cover
+    from mock import Mock, patch
+
+from nose.tools import *
+from nose.plugins.skip import SkipTest
+
+sys.modules['smbus'] = Mock()
+from qem import poll_benchmark
+from qem.backplane import Backplane
+
+
+class MockBus(object):
+    """SMBus substitute returning zero readings.
+
+    A Mock bus would record every call made to it, which the benchmark would measure as
+    allocations made by the poll loop. The SI570 reads back its factory configuration, so
+    that the clock can be calibrated.
+    """
+
+    SI570_ADDRESS = 0x55
+    SI570_REGISTERS = [0x01, 0xC2, 0xBC, 0x01, 0x1E, 0xB8]
+
+    def __init__(self, busnum):
+        pass
+
+    def read_byte_data(self, address, reg):
+        return 0
+
+    def read_word_data(self, address, reg):
+        return 0
+
+    def read_i2c_block_data(self, address, reg, length):
+        if address == self.SI570_ADDRESS:
+            return self.SI570_REGISTERS[:length]
+        return [0] * length
+
+    def write_byte(self, address, value):
+        pass
+
+    def write_byte_data(self, address, reg, value):
+        pass
+
+    def write_word_data(self, address, reg, value):
+        pass
+
+    def write_i2c_block_data(self, address, reg, data):
+        pass
+
+
+class TestPollBenchmark():
+
+    @classmethod
+    def setup_class(cls):
+
+        # The backplane devices are derived from both the lpdpower and qem I2CDevice classes
+        with patch('lpdpower.i2c_device.smbus.SMBus', MockBus), \
+                patch('qem.i2c_device.smbus.SMBus', MockBus):
+            cls.backplane = Backplane()
+            cls.backplane.initialise()
+
+    def test_initialised(self):
+
+        assert_true(self.backplane.ready)
+
+    def test_poll_allocations_within_limit(self):
+
+        if poll_benchmark.tracemalloc is None:
+            raise SkipTest("tracemalloc is not available")
+
+        result = poll_benchmark.measure_poll_allocations(
+            self.backplane.poll_all_sensors, cycles=200, warmup=20)
+
+        assert_equal(result["cycles"], 200)
+        assert_true(result["bytes_per_cycle"] <= poll_benchmark.MAX_BYTES_PER_CYCLE)
+
+    def test_tracemalloc_unavailable(self):
+
+        with patch.object(poll_benchmark, 'tracemalloc', None):
+            with assert_raises_regexp(RuntimeError, "tracemalloc is not available"):
+                poll_benchmark.measure_poll_allocations(self.backplane.poll_all_sensors)
@@ -0,0 +1,269 @@
+"""Test cases for the ResistorRegulator class from qem.
+
+James Hogge, STFC Application Engineering Group.
+"""
+
+import sys
+import math
+
+if sys.version_info[0] == 3:  # pragma: no cover
+    from unittest.mock import Mock
+else:                         # pragma: no cover
+    from mock import Mock
+
+from nose.tools import *
+
+from qem.regulator import ResistorRegulator, RegulationError
+
+
+def linear(code):
+    """Simulated rail reading rising linearly with the wiper code."""
+    return 0.01 * code
+
+
+def exponential(code):
+    """Simulated rail reading rising exponentially with the wiper code."""
+    return 0.05 * math.exp(code / 60.0)
+
+
+def make_backplane(response, code=128, lut_code=None):
+    """Create a mock backplane whose feedback reading follows a simulated response.
+
+    Resistor 3 is monitored by channel 8, resistor 0 has no monitored rail.
+
+    :param response: function mapping the wiper code to the reading of the feedback channel
+    :param code: initial wiper code of every resistor
+    :param lut_code: code returned by the lookup table, None for a target out of range
+    """
+    backplane = Mock()
+    backplane.RESISTOR_CHANNELS = {3: [8]}
+    backplane.CURRENT_MULTIPLIERS = [1.2] * 13
+    backplane.VOLTAGE_MULTIPLIERS = [1.2] * 13
+    backplane.resistor_luts = {3: [response(code) for code in range(256)]}
+    backplane.raw_voltages = [0.0] * 13
+    backplane.raw_currents = [0.0] * 13
+    backplane.wipers = [code] * 7
+    backplane.volatile_mode = False
+
+    def set_resistor_wiper(resistor, code, save=True):
+        backplane.wipers[resistor] = code
+
+    def poll_channels(channels):
+        for channel in channels:
+            backplane.raw_voltages[channel] = response(backplane.wipers[3])
+
+    def nearest_wiper_code(resistor, value):
+        if lut_code is None:
+            raise ValueError("out of range")
+        return lut_code
+
+    def set_volatile_mode(enable):
+        backplane.volatile_mode = enable
+
+    backplane.get_resistor_index.side_effect = lambda resistor: resistor
+    backplane.get_adc_channel.side_effect = lambda channel: channel
+    backplane.get_resistor_name.side_effect = lambda resistor: "R{}".format(resistor)
+    backplane.get_adc_name.side_effect = lambda channel: "CH{}".format(channel)
+    backplane.get_resistor_units.return_value = "V"
+    backplane.get_resistor_wiper.side_effect = lambda resistor: backplane.wipers[resistor]
+    backplane.set_resistor_wiper.side_effect = set_resistor_wiper
+    backplane.poll_channels.side_effect = poll_channels
+    backplane.nearest_wiper_code.side_effect = nearest_wiper_code
+    backplane.get_volatile_mode.side_effect = lambda: backplane.volatile_mode
+    backplane.set_volatile_mode.side_effect = set_volatile_mode
+
+    return backplane
+
+
+class TestResistorRegulator():
+
+    def regulate(self, backplane, **spec):
+
+        regulator = ResistorRegulator(backplane)
+        spec.setdefault("resistor", 3)
+        regulator.regulate(spec)
+        return regulator.get_results()
+
+    def test_linear_response_converges(self):
+
+        backplane = make_backplane(linear)
+        results = self.regulate(backplane, target=1.5, tolerance=0.001)
+
+        assert_true(results["converged"])
+        assert_equal(results["code"], 150)
+        assert_equal(backplane.wipers[3], 150)
+        assert_true(results["writes"] <= 4)
+
+    def test_exponential_response_converges(self):
+
+        backplane = make_backplane(exponential, code=20)
+        results = self.regulate(backplane, target=1.0, tolerance=0.01)
+
+        assert_true(results["converged"])
+        assert_true(abs(results["error"]) <= 0.01)
+        assert_true(results["writes"] <= ResistorRegulator.MAX_WRITES)
+
+    def test_search_starts_from_current_code(self):
+
+        backplane = make_backplane(linear, code=100)
+        results = self.regulate(backplane, target=1.2, tolerance=0.001)
+
+        codes = [entry["code"] for entry in results["history"]]
+        assert_equal(codes[0], 100)
+        assert_true(0 not in codes and 255 not in codes)
+
+    def test_search_starts_from_lookup_table_code(self):
+
+        backplane = make_backplane(linear, code=10, lut_code=149)
+        results = self.regulate(backplane, target=1.5, tolerance=0.001)
+
+        assert_equal(results["start"], 149)
+        assert_equal(results["history"][0]["code"], 149)
+        assert_true(results["converged"])
+
+    def test_bracket_widens_progressively(self):
+
+        backplane = make_backplane(exponential, code=10)
+        results = self.regulate(backplane, target=3.0, tolerance=0.01)
+
+        codes = [entry["code"] for entry in results["history"]]
+        steps = [abs(b - a) for a, b in zip(codes, codes[1:])]
+        assert_equal(steps[0], ResistorRegulator.INITIAL_STEP)
+        for n in range(1, len(steps)):
+            assert_true(steps[n] <= 2 * max(steps[:n]))
+
+    def test_default_tolerance_converges(self):
+
+        backplane = make_backplane(linear, lut_code=150)
+        results = self.regulate(backplane, target=1.503)
+
+        assert_almost_equal(results["tolerance"], 0.005)
+        assert_true(results["converged"])
+        assert_equal(results["code"], 150)
+        assert_true(results["committed"])
+
+    def test_default_tolerance_without_monitored_rail(self):
+
+        regulator = ResistorRegulator(make_backplane(linear))
+        tolerance = regulator.get_default_tolerance(0, 8, "voltage", 1.0)
+
+        assert_almost_equal(tolerance, 1.2 / ResistorRegulator.ADC_FULL_SCALE / 2)
+
+    def test_writes_include_final_write(self):
+
+        backplane = make_backplane(exponential, code=20)
+        results = self.regulate(backplane, target=1.0, tolerance=0.0, max_writes=6)
+
+        assert_equal(results["writes"], 6)
+        assert_equal(len(results["history"]), 5)
+        assert_equal(backplane.set_resistor_wiper.call_count, results["writes"])
+
+    def test_too_few_writes(self):
+
+        with assert_raises_regexp(RegulationError, "at least 3 writes"):
+            self.regulate(make_backplane(linear), target=1.0, max_writes=2)
+
+    def test_channel_required_without_monitored_rail(self):
+
+        backplane = make_backplane(linear)
+        with assert_raises_regexp(RegulationError, "requires a feedback channel"):
+            self.regulate(backplane, resistor=0, target=1.0)
+        assert_false(backplane.set_resistor_wiper.called)
+
+    def test_converged_code_committed(self):
+
+        backplane = make_backplane(linear)
+        results = self.regulate(backplane, target=1.5, tolerance=0.001)
+
+        assert_true(results["committed"])
+        backplane.commit_resistor.assert_called_once_with(3)
+
+    def test_commit_disabled(self):
+
+        backplane = make_backplane(linear)
+        results = self.regulate(backplane, target=1.5, tolerance=0.001, commit=False)
+
+        assert_false(results["committed"])
+        assert_false(backplane.commit_resistor.called)
+
+    def test_unreachable_target_restores_original_code(self):
+
+        backplane = make_backplane(linear, code=100)
+        results = self.regulate(backplane, target=5.0, tolerance=0.001)
+
+        assert_false(results["converged"])
+        assert_false(results["bracketed"])
+        assert_false(results["committed"])
+        assert_equal(results["code"], 100)
+        assert_equal(backplane.wipers[3], 100)
+        assert_false(backplane.commit_resistor.called)
+
+    def test_unresponsive_channel_restores_original_code(self):
+
+        backplane = make_backplane(lambda code: 1.0, code=100)
+        results = self.regulate(backplane, target=1.5, tolerance=0.001)
+
+        assert_false(results["converged"])
+        assert_equal(results["writes"], 3)
+        assert_equal(backplane.wipers[3], 100)
+        assert_false(backplane.commit_resistor.called)
+
+    def test_bracket_closed_without_tolerance_not_committed(self):
+
+        backplane = make_backplane(linear)
+        results = self.regulate(backplane, target=1.505, tolerance=0.001)
+
+        assert_false(results["converged"])
+        assert_true(results["bracket_closed"])
+        assert_false(results["committed"])
+        assert_false(backplane.commit_resistor.called)
+        assert_true(backplane.wipers[3] in (150, 151))
+
+    def test_refine_linear_bracket(self):
+
+        regulator = ResistorRegulator(make_backplane(linear))
+        codes = []
+
+        def measure(code):
+            codes.append(code)
+            return linear(code) - 1.5
+
+        lo, hi = regulator.refine(measure, 0, 255, -1.5, linear(255) - 1.5, 0.001, 16, codes)
+        assert_equal(codes, [150])
+
+    def test_estimate_on_bracket_end_steps_inward(self):
+
+        regulator = ResistorRegulator(make_backplane(linear))
+        codes = []
+
+        def measure(code):
+            codes.append(code)
+            return 1.0
+
+        regulator.refine(measure, 0, 100, -1.0, 1000.0, 0.0, 16, codes)
+        assert_equal(codes[0], 1)
+
+    def test_volatile_mode_restored(self):
+
+        backplane = make_backplane(linear)
+        self.regulate(backplane, target=1.5, tolerance=0.001)
+
+        backplane.set_volatile_mode.assert_any_call(True)
+        assert_false(backplane.volatile_mode)
+
+    def test_non_volatile_search(self):
+
+        backplane = make_backplane(linear)
+        self.regulate(backplane, target=1.5, tolerance=0.001, volatile=False)
+
+        assert_false(backplane.set_volatile_mode.called)
+
+    def test_missing_target(self):
+
+        with assert_raises_regexp(RegulationError, "requires a resistor and a target"):
+            self.regulate(make_backplane(linear))
+
+    def test_invalid_field(self):
+
+        with assert_raises_regexp(RegulationError, "must be current or voltage"):
+            self.regulate(make_backplane(linear), target=1.0, field="power")
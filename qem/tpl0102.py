@@ -7,6 +7,8 @@ divider and rheostat mode respectively.
 James Hogge, STFC Application Engineering Group.
 """
 
+import time
+
 from i2c_device import I2CDevice, I2CException
 
 class TPL0102(I2CDevice):
@@ -16,15 +18,25 @@ class TPL0102(I2CDevice):
     in rheostat mode or the potential difference at the output in potential divider mode.
     """
 
-    def __init__(self, address=0x50, **kwargs):
+    #Time allowed for a non-volatile write to complete and interval between polls (seconds)
+    NV_WRITE_TIMEOUT = 0.1
+    NV_POLL_INTERVAL = 0.001
+
+    def __init__(self, address=0x50, state=None, **kwargs):
         """Initialise the TPL0102 device.
         :param address: The address of the TPL0102 default: 0x50
+        :param state: saved shadow register state from get_state(), verified against the
+        device with a single read rather than reading back each register
         """
 
         I2CDevice.__init__(self, address, **kwargs)
 
+        #Access control register, read on first use unless restored from saved state
+        self.__acr = None
+
         #Read back current wiper settings
-        self.__wiper_pos = [self.readU8(0), self.readU8(1)]
+        if not (state and self.restore_state(state)):
+            self.__wiper_pos = [self.readU8(0), self.readU8(1)]
         self.__tot_resistance = 100.0
         self.__low_pd = [0.0,0.0]
         self.__high_pd = [3.3, 3.3]
@@ -97,24 +109,95 @@ class TPL0102(I2CDevice):
         return self.__wiper_pos[wiper]
 
 
+    def get_state(self):
+        """Gets the shadow register state of the device for persisting
+        :returns: dict of wiper positions and access control register
+        """
+
+        return {"wipers": list(self.__wiper_pos), "acr": self.__acr}
+
+    def restore_state(self, state):
+        """Restores saved shadow register state if it matches the device
+        The wiper and access control registers are verified with a single block read.
+        :param state: state from get_state()
+        :returns: True if the state matched and was restored, False otherwise
+        """
+
+        try:
+            wipers = [int(wiper) for wiper in state["wipers"]]
+            acr = state["acr"]
+        except (KeyError, TypeError, ValueError):
+            return False
+
+        data = self.readList(0, 17)
+        if data == I2CDevice.ERROR or data[0:2] != wipers or acr not in (None, data[16]):
+            return False
+
+        self.__wiper_pos = wipers
+        self.__acr = data[16]
+        return True
+
+    def __update_acr(self, mask, enable):
+        """Sets or clears bits of the access control register
+        The register is only written if its value changes.
+        :param mask: bits to set or clear
+        :param enable: true - set bits, false - clear bits
+        """
+
+        if self.__acr is None:
+            self.__acr = self.readU8(16)
+
+        dat = self.__acr | mask if enable else self.__acr & ~mask
+        if dat != self.__acr:
+            self.write8(16, dat)
+            self.__acr = dat
+
     def set_non_volatile(self, enable):
         """Sets whether to use non volatile registers on the I2C device
         :param enable: true - non volatile, false - volatile
         """
 
-        dat = self.readU8(16)
-        if enable: dat |= 0x80
-        else: dat &= ~0x80
+        self.__update_acr(0x80, enable)
 
-        self.write8(16, dat)
+    def get_non_volatile(self):
+        """Gets whether wiper writes go to the non volatile registers
+        :returns: true - non volatile, false - volatile
+        """
+
+        if self.__acr is None:
+            self.__acr = self.readU8(16)
+
+        return bool(self.__acr & 0x80)
+
+    def commit(self):
+        """Copies the current wiper positions to the non volatile registers
+        This allows wipers to be changed quickly in volatile mode, e.g. during a scan, with
+        the final positions stored once. The device is returned to its previous mode.
+        """
+
+        volatile = not self.get_non_volatile()
+        self.set_non_volatile(True)
+
+        for wiper in [0, 1]:
+            self.write8(wiper, self.__wiper_pos[wiper])
+            self.__wait_nv_write()
+
+        if volatile:
+            self.set_non_volatile(False)
+
+    def __wait_nv_write(self):
+        """Waits for a non volatile write to complete, indicated by the WIP bit of the ACR
+        """
+
+        deadline = time.time() + self.NV_WRITE_TIMEOUT
+        while self.readU8(16) & 0x20:
+            if time.time() > deadline:
+                raise I2CException("Timed out waiting for TPL0102 non volatile write to complete")
+            time.sleep(self.NV_POLL_INTERVAL)
 
     def set_shutdown(self, enable):
         """Sets whether to use shutdown mode
         :param enable: true - device enters shutdown mode, false - normal operation
         """
 
-        dat = self.readU8(16)
-        if enable: dat |= 0x40
-        else: dat &= ~0x40
-
-        self.write8(16, dat)
+        self.__update_acr(0x40, enable)